@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2016-2019 Sven Willner <sven.willner@pik-potsdam.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Generates synthetic job trees for benchmarking
+
+The tree consists of `depth` layers of `width` jobs each. Every job runs for
+all combinations of the global `foreach` parameters (and of the files matched
+by `files` input files if given) and depends on all jobs of the previous
+layer for the same parameters. A final job `all` depends on all jobs of the
+last layer. With `pack`, runs of the other jobs are packed into allocations
+of that many runs, sharing PACK_CORES cores. With `auto_arrays`, runs of
+the other jobs are grouped into arrays of up to AUTO_ARRAY_SIZE runs
+automatically.
+"""
+
+import argparse
+import os
+
+import pyaml
+
+PACK_CORES = 16
+AUTO_ARRAY_SIZE = 1000
+
+
+def generate(
+    directory,
+    parameters=2,
+    values=10,
+    depth=3,
+    width=2,
+    arrays=False,
+    files=0,
+    pack=0,
+    auto_arrays=False,
+):
+    """Writes jobs.yml (and input files) to directory, returns name of root job"""
+    os.makedirs(os.path.join(directory, "scripts"), exist_ok=True)
+    variables = [f"p{i}" for i in range(parameters)]
+    settings = {
+        "account": "benchmark",
+        "foreach": {v: list(range(values)) for v in variables},
+        "scheduler": {"partition": "benchmark", "time": "0:10:00"},
+        "jobs": {},
+    }
+
+    if files:
+        os.makedirs(os.path.join(directory, "out", "input"), exist_ok=True)
+        for i in range(files):
+            with open(
+                os.path.join(directory, "out", "input", f"file{i}.txt"), "w"
+            ) as f:
+                f.write(f"{i}\n")
+        variables.append("file")
+
+    values_string = "_".join("{{" + v + "}}" for v in variables)
+    for layer in range(depth):
+        for i in range(width):
+            job = {
+                "parameters": {"value": values_string},
+                "code": f"echo {values_string} > job{layer}_{i}_{values_string}.txt",
+                "output": [f"job{layer}_{i}_{values_string}.txt"],
+            }
+            if layer == 0:
+                if files:
+                    job["foreach"] = ["input/file{{file}}.txt"]
+            else:
+                job["depends"] = [
+                    {"job": f"job{layer - 1}_{j}", "foreach": variables}
+                    for j in range(width)
+                ]
+            if arrays and (layer + i) % 2:
+                job["array"] = True
+            elif pack:
+                job["scheduler"] = {"pack": pack, "pack_cores": PACK_CORES}
+            elif auto_arrays:
+                job["scheduler"] = {"auto_array": AUTO_ARRAY_SIZE}
+            settings["jobs"][f"job{layer}_{i}"] = job
+
+    settings["jobs"]["all"] = {
+        "depends": [{"job": f"job{depth - 1}_{i}", "foreach": []} for i in range(width)]
+    }
+
+    with open(os.path.join(directory, "jobs.yml"), "w") as f:
+        f.write(pyaml.dump(settings))
+    return "all"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="generate synthetic jobs.yml")
+    parser.add_argument("directory", type=str, help="directory to write jobs.yml to")
+    parser.add_argument("--parameters", type=int, default=2, help="number of parameters")
+    parser.add_argument("--values", type=int, default=10, help="values per parameter")
+    parser.add_argument("--depth", type=int, default=3, help="number of layers")
+    parser.add_argument("--width", type=int, default=2, help="jobs per layer")
+    parser.add_argument("--arrays", action="store_true", help="make every other job an array")
+    parser.add_argument("--files", type=int, default=0, help="number of input files")
+    parser.add_argument("--pack", type=int, default=0, help="runs per allocation")
+    parser.add_argument(
+        "--auto-arrays", action="store_true", help="group runs into arrays automatically"
+    )
+    args = parser.parse_args()
+    generate(
+        args.directory,
+        args.parameters,
+        args.values,
+        args.depth,
+        args.width,
+        args.arrays,
+        args.files,
+        args.pack,
+        args.auto_arrays,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2016-2019 Sven Willner <sven.willner@pik-potsdam.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures the startup time of the command line
+
+For each command the modules it needs are imported in a fresh interpreter
+(several times, reporting the median), and the packages slowest to import
+are listed as reported by `python -X importtime`.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = {
+    "interpreter": "pass",
+    "runid": "import jobsched.cli, jobsched.runfile",
+    "status": "import jobsched.cli, jobsched.runfile, jobsched.states",
+    "tree": "import jobsched.cli, ruamel.yaml",
+    "run": "import jobsched.cli, jobsched.jobs, tqdm, ruamel.yaml",
+}
+
+
+def import_times(code):
+    """Returns total import time and cumulative times of packages in us"""
+    p = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+    total = 0
+    packages = {}
+    for line in p.stderr.decode("utf8").split("\n"):
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        if not name.startswith("  "):  # imported at top level
+            total += int(cumulative)
+        name = name.strip()
+        if "." not in name and name != "jobsched":
+            packages[name] = max(packages.get(name, 0), int(cumulative))
+    return total, packages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="measure jobsched import times")
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="runs per command (default: 5)"
+    )
+    parser.add_argument(
+        "--top", type=int, default=5, help="slowest imports to list (default: 5)"
+    )
+    parser.add_argument(
+        "commands",
+        type=str,
+        nargs="*",
+        help="commands to measure (default: all of {})".format(", ".join(COMMANDS)),
+    )
+    args = parser.parse_args()
+
+    for command in args.commands or COMMANDS:
+        runs = [import_times(COMMANDS[command]) for _ in range(args.repeat)]
+        total = statistics.median(t for t, _ in runs)
+        print("{:<12} {:>8.1f} ms".format(command, total / 1000))
+        slowest = sorted(runs[-1][1].items(), key=lambda i: -i[1])[: args.top]
+        for name, t in slowest:
+            print("    {:<30} {:>8.1f} ms".format(name, t / 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2016-2019 Sven Willner <sven.willner@pik-potsdam.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Runs the benchmark scenarios against fake Slurm binaries
+
+Every scenario runs in a separate process in a temporary directory, with the
+fake sbatch/sacct/squeue/scontrol from benchmarks/bin first in PATH (pyslurm
+must not be installed, otherwise it is used instead). For each scenario the
+job tree is planned and submitted once, then planned again with the states
+of the former runs resolved via sacct. Reported are
+
+    planning    time to read job descriptions and expand file combinations
+    schedule    time to walk the tree and plan all submissions
+    submit/s    submissions per second until all were submitted
+    replan      planning and walking the tree again once all runs are done
+    peak RSS    peak resident memory of the process
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from generate import generate  # noqa: E402
+
+SCENARIOS = {
+    "small": dict(parameters=2, values=5, depth=2, width=2),
+    "wide": dict(parameters=2, values=15, depth=2, width=8),
+    "deep": dict(parameters=1, values=20, depth=20, width=2),
+    "arrays": dict(parameters=2, values=20, depth=3, width=2, arrays=True),
+    "files": dict(parameters=1, values=10, depth=2, width=2, files=200),
+    "packed": dict(parameters=2, values=20, depth=3, width=2, pack=50),
+    "auto": dict(parameters=2, values=20, depth=3, width=2, auto_arrays=True),
+}
+
+
+def run_scenario(directory, job, submission_threads):
+    """Plans and submits job in directory, returns measurements"""
+    from jobsched.cli import load_settings
+    from jobsched.executors import SlurmExecutor
+    from jobsched.jobs import JobList
+    from jobsched.parameters import ParameterCombinations
+
+    os.chdir(directory)
+    res = {}
+    former_runs = {}
+    for attempt in ["first", "replan"]:
+        settings = load_settings()
+        settings["logdir"] = os.path.join(directory, "log")
+        settings["workdir"] = os.path.join(directory, "out")
+        executor = SlurmExecutor(0, submission_threads)
+
+        start = time.perf_counter()
+        joblist = JobList(settings, former_runs, executor)
+        possible = ParameterCombinations(settings["foreach"])
+        run_job = joblist.get_job(job, possible)
+        prepared = time.perf_counter()
+        graph = joblist.plan(run_job, possible)
+        planned = time.perf_counter()
+        executor.open()
+        joblist.submit(graph)
+        executor.close()
+        joblist.resolve_run_ids()
+        submitted = time.perf_counter()
+
+        if attempt == "first":
+            res["runs"] = executor.scheduled_count
+            res["submissions"] = len(executor.futures)
+            res["planning"] = prepared - start
+            res["schedule"] = planned - prepared
+            res["submit_rate"] = len(executor.futures) / (submitted - planned)
+        else:
+            res["replan"] = planned - start
+            res["rescheduled"] = executor.scheduled_count
+    res["peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser(description="run jobsched benchmarks")
+    parser.add_argument(
+        "--submission-threads",
+        type=int,
+        default=4,
+        help="number of concurrent submissions (default: 4)",
+    )
+    parser.add_argument(
+        "--output", type=str, default=None, help="file to write JSON results to"
+    )
+    parser.add_argument("--worker", type=str, help=argparse.SUPPRESS)
+    parser.add_argument(
+        "scenarios",
+        type=str,
+        nargs="*",
+        help="scenarios to run (default: all of {})".format(", ".join(SCENARIOS)),
+    )
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        json.dump(run_scenario(args.worker, "all", args.submission_threads), sys.stdout)
+        return
+
+    env = dict(os.environ)
+    env["PATH"] = os.path.join(BENCHMARK_DIR, "bin") + os.pathsep + env["PATH"]
+    results = {}
+    print(
+        "{:<10} {:>8} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+            "scenario",
+            "runs",
+            "submits",
+            "plan [s]",
+            "sched [s]",
+            "submit/s",
+            "replan [s]",
+            "RSS [MB]",
+        )
+    )
+    for name in args.scenarios or SCENARIOS:
+        with tempfile.TemporaryDirectory() as directory:
+            generate(directory, **SCENARIOS[name])
+            env["JOBSCHED_BENCH_STATE"] = directory
+            p = subprocess.run(
+                [
+                    sys.executable,
+                    os.path.abspath(__file__),
+                    "--submission-threads",
+                    str(args.submission_threads),
+                    "--worker",
+                    directory,
+                ],
+                env=env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+        if p.returncode:
+            sys.stderr.write(p.stderr.decode("utf8"))
+            raise RuntimeError(f"Scenario {name} failed")
+        res = json.loads(p.stdout.decode("utf8").splitlines()[-1])
+        results[name] = res
+        print(
+            "{:<10} {:>8} {:>8} {:>10.3f} {:>10.3f} {:>10.1f} {:>10.3f} {:>10.1f}".format(
+                name,
+                res["runs"],
+                res["submissions"],
+                res["planning"],
+                res["schedule"],
+                res["submit_rate"],
+                res["replan"],
+                res["peak_rss"] / 2 ** 20,
+            )
+        )
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
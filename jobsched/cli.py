@@ -17,37 +17,25 @@
 
 import argparse
 import os
-import shelve
 import subprocess
 import sys
 
-import pyaml
-from ruamel import yaml
-from tqdm import tqdm
+from .executors import (
+    DebugExecutor,
+    DryExecutor,
+    LocalExecutor,
+    SimulatedExecutor,
+    SlurmExecutor,
+    tprint,
+)
+from .helpers import ensure_abspath, get_setting, load_yaml
+from .profiling import PROFILER
+from .runfile import migrate_runfile, open_runfile
+from .states import STATE_NAMES, JobState, RunStates, runtime_history
 
-from .executors import DebugExecutor, DryExecutor, LocalExecutor, SlurmExecutor, tprint
-from .helpers import ensure_abspath, get_setting
-from .jobs import JobList
-from .parameters import ParameterCombinations
-from .utils import can_use_pick, pick
 
-
-def load_runfile(filename):
-    if filename.endswith(".yml"):
-        if os.path.exists(filename):
-            f = open(filename, "r")
-            former_runs = yaml.round_trip_load(f)
-        else:
-            f = open(filename, "w")
-            former_runs = {}
-    else:
-        f = shelve.open(filename)
-        former_runs = f.get("former_runs", {})
-    return f, former_runs
-
-
-def command_run(settings):
-    parser = argparse.ArgumentParser(description="schedule runs for job")
+def add_executor_arguments(parser):
+    """Adds arguments for choosing and configuring the executor"""
     parser.add_argument(
         "--dry", action="store_true", help="dry run, do not actually schedule jobs"
     )
@@ -58,13 +46,41 @@ def command_run(settings):
         "--debug", action="store_true", help="only show which jobs would be scheduled"
     )
     parser.add_argument(
-        "--force", action="store_true", help="force rescheduling of given job"
+        "--simulate",
+        action="store_true",
+        help="do not schedule, but report makespan on a simulated cluster",
     )
     parser.add_argument(
-        "--workdir", type=str, default="out", help="working directory (default: out)"
+        "--cores",
+        type=int,
+        default=None,
+        help="number of cores to use with --local or per node with --simulate "
+        "(default: all)",
     )
     parser.add_argument(
-        "--logdir", type=str, default="log", help="log directory (default: log)"
+        "--nodes",
+        type=int,
+        default=1,
+        help="number of nodes with --simulate (default: 1)",
+    )
+    parser.add_argument(
+        "--queue-delay",
+        type=float,
+        default=0,
+        help="seconds until runs start once eligible with --simulate (default: 0)",
+    )
+    parser.add_argument(
+        "--runtime",
+        type=float,
+        default=None,
+        help="runtime in seconds of runs with --simulate for jobs without "
+        "scheduler runtime or history (default: time limit)",
+    )
+    parser.add_argument(
+        "--history",
+        type=str,
+        default=None,
+        help="runfile to take mean runtimes of jobs from with --simulate",
     )
     parser.add_argument(
         "--submission-delay",
@@ -72,6 +88,119 @@ def command_run(settings):
         default=0.1,
         help="delay between submissions in seconds (default: 0.1)",
     )
+    parser.add_argument(
+        "--submission-threads",
+        type=int,
+        default=4,
+        help="number of concurrent submissions (default: 4)",
+    )
+    parser.add_argument(
+        "--init-threads",
+        type=int,
+        default=4,
+        help="number of init commands to run concurrently (default: 4)",
+    )
+    parser.add_argument(
+        "--runfile",
+        type=str,
+        default="jobs.run",
+        help="file to read/write scheduled runs from/to (.db: SQLite, .yml: YAML)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="time planning and submission phases, print summary to stderr",
+    )
+    parser.add_argument(
+        "--profile-file",
+        type=str,
+        default="profile.json",
+        help="file to write profiling report to (default: profile.json)",
+    )
+
+
+def create_executor(args):
+    if args.debug:
+        executor = DebugExecutor()
+    elif args.dry:
+        executor = DryExecutor()
+    elif args.local:
+        executor = LocalExecutor(args.cores, args.init_threads)
+    elif args.simulate:
+        history = {}
+        if args.history is not None:
+            history_runfile = open_runfile(args.history)
+            history = runtime_history(history_runfile.former_runs)
+            history_runfile.close()
+        executor = SimulatedExecutor(
+            args.nodes,
+            args.cores or os.cpu_count(),
+            args.queue_delay,
+            args.runtime,
+            history,
+        )
+    else:
+        executor = SlurmExecutor(
+            args.submission_delay, args.submission_threads, args.init_threads
+        )
+    if args.profile:
+        PROFILER.wrap_methods(
+            executor, "executor", ["init", "schedule", "store", "close"]
+        )
+    return executor
+
+
+def default_account(args):
+    if args.debug or args.simulate:
+        return "account"
+    return (
+        subprocess.check_output(["slurm-bestaccount"], shell=True)
+        .decode("utf8")
+        .strip()
+    )
+
+
+def records_runs(args):
+    """Returns whether the executor used actually submits runs"""
+    return not args.debug and not args.dry and not args.local and not args.simulate
+
+
+def writes_logs(args):
+    """Returns whether the executor used runs or submits scripts writing logs"""
+    return not args.debug and not args.dry and not args.simulate
+
+
+def submit_plan(joblist, graph, args, runfile):
+    joblist.executor.open()
+    try:
+        try:
+            joblist.submit(graph)
+        finally:
+            joblist.executor.close()
+    finally:
+        # record the runs submitted so far, also if others failed
+        joblist.resolve_run_ids()
+        if records_runs(args):
+            runfile.save()
+        runfile.close()
+
+    if args.profile:
+        PROFILER.write(args.profile_file)
+        PROFILER.print_summary()
+
+
+def command_run(settings):
+    parser = argparse.ArgumentParser(description="schedule runs for job")
+    add_executor_arguments(parser)
+    parser.add_argument(
+        "--force", action="store_true", help="force rescheduling of given job"
+    )
+    parser.add_argument(
+        "--workdir", type=str, default="out", help="working directory (default: out)"
+    )
+    parser.add_argument(
+        "--logdir", type=str, default="log", help="log directory (default: log)"
+    )
     parser.add_argument(
         "--settings",
         type=str,
@@ -79,18 +208,23 @@ def command_run(settings):
         help="settings to overwrite from jobs file",
     )
     parser.add_argument(
-        "--runfile",
+        "--plan",
         type=str,
-        default="jobs.run",
-        help="file to read/write scheduled runs from/to",
+        default=None,
+        help="only plan runs and write them to this file, to be submitted later",
     )
     parser.add_argument("job", type=str, nargs="?", help="name of job")
     args = parser.parse_args(sys.argv[2:])
 
+    if args.profile:
+        PROFILER.enable()
+
     args.workdir = os.path.abspath(args.workdir)
     args.logdir = os.path.abspath(args.logdir)
 
     if args.job is None:
+        from .utils import can_use_pick, pick
+
         js = sorted(settings["jobs"].keys())
         if len(js) == 1:
             job = js[0]
@@ -101,34 +235,25 @@ def command_run(settings):
     else:
         job = args.job
 
-    runfile, former_runs = load_runfile(args.runfile)
-    if not args.dry and not args.debug:
+    runfile = open_runfile(args.runfile)
+    former_runs = runfile.former_runs
+    if writes_logs(args) and args.plan is None:
         if not os.path.exists(args.logdir):
             os.mkdir(args.logdir)
 
-    settings.update(
-        yaml.round_trip_load(args.settings) if args.settings is not None else {}
-    )
-    if not "account" in settings:
-        if args.debug:
-            settings["account"] = "account"
-        else:
-            settings["account"] = (
-                subprocess.check_output(["slurm-bestaccount"], shell=True)
-                .decode("utf8")
-                .strip()
-            )
+    if args.settings is not None:
+        settings.update(load_yaml(args.settings) or {})
+    if not "account" in settings and args.plan is None:
+        settings["account"] = default_account(args)
     settings["logdir"] = args.logdir
     settings["workdir"] = args.workdir
 
-    if args.debug:
-        executor = DebugExecutor()
-    elif args.dry:
-        executor = DryExecutor()
-    elif args.local:
-        executor = LocalExecutor()
-    else:
-        executor = SlurmExecutor(args.submission_delay)
+    executor = create_executor(args)
+
+    from tqdm import tqdm
+
+    from .jobs import JobList
+    from .parameters import ParameterCombinations
 
     progressbar = tqdm(unit="j", desc="Preparing", leave=False)
     joblist = JobList(settings, former_runs, executor)
@@ -136,17 +261,55 @@ def command_run(settings):
     run_job = joblist.get_job(job, possible)
     progressbar.close()
 
-    executor.open()
-    run_job.schedule_tree(possible, {}, args.force)
-    executor.close()
+    graph = joblist.plan(run_job, possible, args.force)
+
+    if args.plan is not None:
+        graph.settings["overrides"] = args.settings
+        graph.save(args.plan)
+        runfile.close()
+        for jobname, reasons in sorted(graph.summary().items()):
+            tprint(
+                "{}: {}".format(
+                    jobname, ", ".join(f"{n} {r}" for r, n in sorted(reasons.items()))
+                )
+            )
+        tprint(f"Planned {graph.run_count()} runs in {len(graph.nodes)} submissions")
+        if args.profile:
+            PROFILER.write(args.profile_file)
+            PROFILER.print_summary()
+        return
+
+    submit_plan(joblist, graph, args, runfile)
+
+
+def command_submit(settings):
+    parser = argparse.ArgumentParser(
+        description="submit runs planned with `run --plan`"
+    )
+    add_executor_arguments(parser)
+    parser.add_argument("plan", type=str, help="file the runs were planned to")
+    args = parser.parse_args(sys.argv[2:])
+
+    if args.profile:
+        PROFILER.enable()
+
+    from .jobs import JobList
+    from .plan import RunGraph
+
+    graph = RunGraph.load(args.plan)
+    overrides = graph.settings.get("overrides")
+    if overrides is not None:
+        settings.update(load_yaml(overrides) or {})
+    settings["account"] = graph.settings["account"] or default_account(args)
+    settings["logdir"] = graph.settings["logdir"]
+    settings["workdir"] = graph.settings["workdir"]
+
+    runfile = open_runfile(args.runfile)
+    if writes_logs(args) and not os.path.exists(settings["logdir"]):
+        os.mkdir(settings["logdir"])
 
-    if not args.debug and not args.dry and not args.local:
-        if args.runfile:
-            if args.runfile.endswith(".yml"):
-                runfile.write(pyaml.dump(former_runs))
-            else:
-                runfile["former_runs"] = former_runs
-            runfile.close()
+    joblist = JobList(settings, runfile.former_runs, create_executor(args))
+    submit_plan(joblist, graph, args, runfile)
 
 
 def command_runid(settings):
@@ -155,16 +318,123 @@ def command_runid(settings):
         "--runfile",
         type=str,
         default="jobs.run",
-        help="file to read/write scheduled runs from/to",
+        help="file to read/write scheduled runs from/to (.db: SQLite, .yml: YAML)",
     )
     parser.add_argument("runid", type=str, help="id of run")
     args = parser.parse_args(sys.argv[2:])
 
-    _, former_runs = load_runfile(args.runfile)
-    for jobname, runs in former_runs.items():
-        for params, info in runs.items():
-            if str(info["id"]).startswith(args.runid):
-                tprint("{}: {}({}) {}".format(info["id"], jobname, params, info))
+    runfile = open_runfile(args.runfile)
+    for jobname, params, info in runfile.find(args.runid):
+        tprint("{}: {}({}) {}".format(info["id"], jobname, params, info))
+    runfile.close()
+
+
+def command_status(settings):
+    parser = argparse.ArgumentParser(description="show state counts of recorded runs")
+    parser.add_argument(
+        "--runfile",
+        type=str,
+        default="jobs.run",
+        help="file to read/write scheduled runs from/to (.db: SQLite, .yml: YAML)",
+    )
+    parser.add_argument(
+        "--by",
+        type=str,
+        action="append",
+        default=[],
+        help="also aggregate per value of this parameter (can be repeated)",
+    )
+    parser.add_argument(
+        "--filter",
+        type=str,
+        action="append",
+        default=[],
+        help="only consider runs with parameter value, as name=value (can be repeated)",
+    )
+    parser.add_argument(
+        "--state",
+        type=str,
+        action="append",
+        choices=list(STATE_NAMES.values()),
+        help="only consider runs in this state (can be repeated)",
+    )
+    parser.add_argument(
+        "--logdir",
+        type=str,
+        default="log",
+        help="log directory, for states of packed runs (default: log)",
+    )
+    parser.add_argument("job", type=str, nargs="*", help="names of jobs (default: all)")
+    args = parser.parse_args(sys.argv[2:])
+
+    filters = {}
+    for f in args.filter:
+        if "=" not in f:
+            raise RuntimeError(f"Invalid filter '{f}', expected name=value")
+        name, value = f.split("=", 1)
+        filters[name] = value
+
+    runfile = open_runfile(args.runfile)
+    jobnames = args.job if args.job else sorted(runfile.former_runs.keys())
+    runs = [
+        (jobname, params, info)
+        for jobname in jobnames
+        for params, info in runfile.former_runs.get(jobname, {}).items()
+        if all(str(params.get(n)) == v for n, v in filters.items())
+    ]
+    run_states = RunStates(os.path.abspath(args.logdir))
+    states = run_states.resolve_all(info for _, _, info in runs)
+    runfile.save()  # record newly known terminal states
+    runfile.close()
+
+    order = [JobState.WAITING, JobState.RUNNING, JobState.DONE, JobState.FAILED]
+    counts = {}
+    for (jobname, params, _), state in zip(runs, states):
+        if args.state and STATE_NAMES[state] not in args.state:
+            continue
+        groups = [(jobname, "")] + [
+            (jobname, f"{n}={params[n]}") for n in args.by if n in params
+        ]
+        for group in groups:
+            if group not in counts:
+                counts[group] = {s: 0 for s in order}
+            counts[group][state] += 1
+
+    header = ["job", "parameter"] + [STATE_NAMES[s] for s in order] + ["total"]
+    rows = [
+        [jobname, value]
+        + [str(c[s]) for s in order]
+        + [str(sum(c.values()))]
+        for (jobname, value), c in sorted(counts.items())
+    ]
+    if not args.by:
+        header = header[:1] + header[2:]
+        rows = [r[:1] + r[2:] for r in rows]
+    widths = [max(len(r[i]) for r in rows + [header]) for i in range(len(header))]
+    for r in [header] + rows:
+        tprint(
+            "  ".join(
+                v.ljust(w) if i < len(header) - len(order) - 1 else v.rjust(w)
+                for i, (v, w) in enumerate(zip(r, widths))
+            )
+        )
+
+
+def command_migrate(settings):
+    parser = argparse.ArgumentParser(
+        description="copy runs from one runfile to another, e.g. jobs.run to jobs.db"
+    )
+    parser.add_argument("source", type=str, help="runfile to read runs from")
+    parser.add_argument(
+        "target", type=str, help="runfile to write runs to (.db for SQLite)"
+    )
+    args = parser.parse_args(sys.argv[2:])
+
+    source = open_runfile(args.source)
+    target = open_runfile(args.target)
+    migrate_runfile(source, target)
+    target.close()
+    source.close()
 
 
 def command_tree(settings):
@@ -191,23 +461,9 @@ def command_tree(settings):
         tprint()
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Schedules runs for a dependencies tree of jobs for given parameter combinations/files",
-        usage="jobsched <command> [<args>]\n\n"
-        "Commands:\n"
-        "    log    Show job log\n"
-        "    run    Run job\n"
-        "    runid  Show runids of job\n"
-        "    status Show job statuses\n"
-        "    tree   Print dependency tree\n",
-        epilog="Written by Sven Willner <sven.willner@pik-potsdam.de>",
-    )
-    parser.add_argument("command", type=str, help="job scheduler command")
-    args = parser.parse_args(sys.argv[1:2])
-
-    with open("jobs.yml", "r") as f:
-        settings = yaml.round_trip_load(f.read())
+def load_settings(filename="jobs.yml"):
+    with open(filename, "r") as f:
+        settings = load_yaml(f)
 
     if "const" not in settings:
         settings["const"] = {}
@@ -222,8 +478,35 @@ def main():
                 settings["foreach"][f] = list(settings["foreach"][f])
             elif not isinstance(settings["foreach"][f], list):
                 settings["foreach"][f] = [settings["foreach"][f]]
+    return settings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Schedules runs for a dependencies tree of jobs for given parameter combinations/files",
+        usage="jobsched <command> [<args>]\n\n"
+        "Commands:\n"
+        "    log      Show job log\n"
+        "    migrate  Copy runs to another runfile format\n"
+        "    run      Run job\n"
+        "    runid    Show runids of job\n"
+        "    status   Show job statuses\n"
+        "    submit   Submit runs planned with run --plan\n"
+        "    tree     Print dependency tree\n",
+        epilog="Written by Sven Willner <sven.willner@pik-potsdam.de>",
+    )
+    parser.add_argument("command", type=str, help="job scheduler command")
+    args = parser.parse_args(sys.argv[1:2])
 
-    COMMANDS = {"run": command_run, "runid": command_runid, "tree": command_tree}
+    COMMANDS = {  # command -> (function, needs settings from jobs.yml)
+        "migrate": (command_migrate, False),
+        "run": (command_run, True),
+        "runid": (command_runid, False),
+        "status": (command_status, False),
+        "submit": (command_submit, True),
+        "tree": (command_tree, True),
+    }
     if args.command not in COMMANDS:
         raise RuntimeError("Command {} not found".format(args.command))
-    COMMANDS[args.command](settings)
+    command, needs_settings = COMMANDS[args.command]
+    command(load_settings() if needs_settings else None)
@@ -15,28 +15,268 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import bisect
+import heapq
+import os
 import subprocess
 import sys
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 
-from tqdm import tqdm
-
-try:
-    import pyslurm
-
-    USE_PYSLURM = True
-except ImportError:
-    print("WARNING: Not using pyslurm")
-    USE_PYSLURM = False
+from .helpers import load_pyslurm
 
 
 def tprint(s=""):
+    from tqdm import tqdm
+
     tqdm.write(s, file=sys.stderr)
 
 
+class PendingRunId:
+    """Run id of a submission which might not have finished yet
+
+    Executors running array tasks separately can give the future of each
+    task, so that runs depending on a single task only wait for that one.
+    """
+
+    def __init__(self, future, suffix="", task_futures=None):
+        self.future = future
+        self.suffix = suffix
+        self.task_futures = task_futures
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, PendingRunId)
+            and self.future is other.future
+            and self.suffix == other.suffix
+        )
+
+    def __hash__(self):
+        return hash((id(self.future), self.suffix))
+
+    def __repr__(self):
+        if self.future.done():
+            return str(self)
+        return "<pending{}>".format(self.suffix)
+
+    def __str__(self):
+        """Blocks until the run id is known"""
+        return self.future.result() + self.suffix
+
+    def task(self, index):
+        future = self.future
+        if self.task_futures is not None:
+            future = self.task_futures[int(index)]
+        return PendingRunId(future, "{}_{}".format(self.suffix, index))
+
+    def member(self, index):
+        return PendingRunId(self.future, "{}+{}".format(self.suffix, index))
+
+
+def array_task_id(run_id, index):
+    if isinstance(run_id, PendingRunId):
+        return run_id.task(index)
+    return f"{run_id}_{index}"
+
+
+def pack_member_id(run_id, index):
+    """Run id of a run packed with others into one allocation"""
+    if isinstance(run_id, PendingRunId):
+        return run_id.member(index)
+    return f"{run_id}+{index}"
+
+
+def dependency_string(run_ids, task_run_ids=None, array_sizes=None):
+    """Returns the dependency option for the given (resolved) run ids
+
+    For arrays, task_run_ids lists the run ids each task depends on; arrays
+    whose tasks all depend on the task with the same index in another array
+    are waited for with aftercorr. Arrays of given size which are depended on
+    as a whole are referred to by their master id only. Packed runs are
+    waited for via their allocation.
+    """
+    run_ids = set(str(run_id).strip().split("+")[0] for run_id in run_ids)
+    run_ids = set(r for r in run_ids if r.split("_")[0] != "local")
+
+    corresponding = set()
+    if task_run_ids is not None:
+        tasks = {}  # array master id -> set of (task index, index of task depended on)
+        for i, deps in enumerate(task_run_ids):
+            for run_id in set(str(d).strip().split("+")[0] for d in deps):
+                master, _, index = run_id.partition("_")
+                if index:
+                    tasks.setdefault(master, set()).add((str(i), index))
+        for master, pairs in tasks.items():
+            if len(pairs) == len(task_run_ids) and all(i == j for i, j in pairs):
+                corresponding.add(master)
+
+    after = {}  # master id -> set of run ids
+    for run_id in run_ids:
+        master = run_id.split("_")[0]
+        if master not in corresponding:
+            after.setdefault(master, set()).add(run_id)
+    res = set()
+    for master, ids in after.items():
+        if array_sizes and master in array_sizes and len(ids) == array_sizes[master]:
+            res.add(master)
+        else:
+            res.update(ids)
+
+    dependency = []
+    if res:
+        dependency.append("afterok:{}".format(":".join(sorted(res))))
+    if corresponding:
+        dependency.append("aftercorr:{}".format(":".join(sorted(corresponding))))
+    return ",".join(dependency)
+
+
 class Executor:
-    def __init__(self):
+    def __init__(self, init_threads=1):
         self.scheduled_count = 0
+        self.stored = set()
+        self.created_dirs = set()
+        self.init_threads = init_threads
+        self.init_pool = None
+        self.inits = {}  # (command, workdir) -> future, of commands started
+        self.inits_lock = threading.Lock()
+        self.init_runs = []  # futures of the init commands of each run
+
+    def makedirs(self, path):
+        """Creates a directory (and its parents) unless already done"""
+        if path not in self.created_dirs:
+            os.makedirs(path, exist_ok=True)
+            self.created_dirs.add(path)
+
+    def init(self, name, commands, workdir):
+        """Runs the init commands of a run one after the other in the background
+
+        Identical commands in the same workdir are only run once, runs needing
+        a command started for another run wait for it. Returns a future to
+        wait for before submitting the run, None if there is nothing to wait
+        for.
+        """
+        with self.inits_lock:
+            futures = [self.inits.get((str(cmd), workdir)) for cmd in commands]
+        if all(f is not None and f.done() and not f.exception() for f in futures):
+            return None
+        if self.init_pool is None:
+            self.init_pool = ThreadPoolExecutor(max_workers=self.init_threads)
+        future = self.init_pool.submit(self._init_run, name, commands, workdir)
+        self.init_runs.append(future)
+        return future
+
+    def _init_run(self, name, commands, workdir):
+        for cmd in commands:
+            key = (str(cmd), workdir)
+            with self.inits_lock:
+                future = self.inits.get(key)
+                started = future is None
+                if started:
+                    future = self.inits[key] = Future()
+            if not started:
+                future.result()  # raises if it failed for another run
+                continue
+            try:
+                subprocess.check_output(
+                    cmd, shell=not isinstance(cmd, list), cwd=workdir
+                )
+            except BaseException as e:  # e.g. also OSError for a missing workdir
+                tprint(f"FAILED init of {name}")
+                future.set_exception(e)
+                raise
+            future.set_result(None)
+
+    def close_inits(self):
+        """Waits for all init commands, raises the first error if any"""
+        if self.init_pool is not None:
+            wait(self.init_runs)
+            self.init_pool.shutdown()
+            for f in self.init_runs:
+                f.result()
+
+    def max_array_size(self):
+        """Maximal number of tasks per array, None if unlimited"""
+        return None
+
+    def store(self, path, content):
+        """Writes a content-addressed file (once) which runs can read"""
+        if path in self.stored:
+            return
+        self.stored.add(path)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "{}.{}".format(path, os.getpid())
+        with open(tmp, "w") as f:
+            f.write(content)
+        os.rename(tmp, path)
+
+    @staticmethod
+    def defer(pool, dependencies, func, *args, wait_for=()):
+        """Submits func to pool once all pending run ids in dependencies are known
+
+        and all futures in wait_for (e.g. of init commands) are done.
+        """
+        future = Future()
+        pending = set(
+            run_id.future for run_id in dependencies if isinstance(run_id, PendingRunId)
+        )
+        pending.update(wait_for)
+        waiting = set(pending)
+        lock = threading.Lock()
+
+        def finish(f):
+            e = f.exception()
+            if e is None:
+                future.set_result(f.result())
+            else:
+                future.set_exception(e)
+
+        def start():
+            for f in pending:
+                if f.exception() is not None:  # do not start if a dependency failed
+                    future.set_exception(f.exception())
+                    return
+            pool.submit(func, *args).add_done_callback(finish)
+
+        def resolved(f):
+            with lock:
+                waiting.discard(f)
+                ready = not waiting
+            if ready:
+                start()
+
+        if waiting:
+            for f in pending:
+                f.add_done_callback(resolved)
+        else:
+            start()
+        return future
+
+    @staticmethod
+    def gather(futures):
+        """Returns a future which is done once all of the given futures are"""
+        if len(futures) == 1:
+            return futures[0]
+        future = Future()
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def done(f):
+            with lock:
+                remaining[0] -= 1
+                last = not remaining[0]
+            if last:
+                for g in futures:
+                    if g.exception() is not None:
+                        future.set_exception(g.exception())
+                        return
+                future.set_result(futures[0].result())
+
+        for f in futures:
+            f.add_done_callback(done)
+        return future
 
 
 class DebugExecutor(Executor):
@@ -46,9 +286,12 @@ class DebugExecutor(Executor):
     def close(self):
         tprint("Would have scheduled {} runs".format(self.scheduled_count))
 
-    def init(self, name, cmd, workdir):
+    def init(self, name, commands, workdir):
         tprint("Init {}".format(name))
 
+    def makedirs(self, path):
+        pass
+
     def open(self):
         pass
 
@@ -57,6 +300,9 @@ class DebugExecutor(Executor):
         tprint("Schedule {}".format(name))
         return "debug"
 
+    def store(self, path, content):
+        pass
+
 
 class DryExecutor(Executor):
     def __init__(self):
@@ -65,52 +311,318 @@ class DryExecutor(Executor):
     def close(self):
         tprint("Would have scheduled {} runs".format(self.scheduled_count))
 
-    def init(self, name, cmd, workdir):
+    def init(self, name, commands, workdir):
         tprint("\nInit {}".format(name))
-        tprint(str(cmd))
+        for cmd in commands:
+            tprint(str(cmd))
+
+    def makedirs(self, path):
+        if path not in self.created_dirs:
+            self.created_dirs.add(path)
+            tprint("\nCreate {}".format(path))
 
     def open(self):
         pass
 
-    def schedule(self, name, run_count, cmd, workdir, **kwargs):
+    def schedule(self, name, run_count, cmd, workdir, dependencies=(), **kwargs):
         self.scheduled_count += run_count
         tprint("\nSchedule {}".format(name))
+        dependency = dependency_string(
+            dependencies, kwargs.get("task_dependencies")
+        )
+        if dependency:
+            tprint("Dependency: {}".format(dependency))
         tprint(cmd)
         return f'"{name}"'
 
+    def store(self, path, content):
+        if path not in self.stored:
+            self.stored.add(path)
+            tprint("\nStore {}".format(path))
+            tprint(content)
 
-class SlurmExecutor(Executor):
-    def __init__(self, submission_delay):
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    days, seconds = divmod(seconds, 86400)
+    res = "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+    if days:
+        return "{}-{:0>8}".format(days, res)
+    return res
+
+
+class SimulatedExecutor(Executor):
+    """Replays the submitted runs on a modelled cluster and reports their timing
+
+    Runs take the runtime given for their job (scheduler setting "runtime"),
+    else their mean runtime from history (job name -> seconds) if available,
+    otherwise the given default runtime or their time limit. Each run is
+    placed on one node with enough free cores for its threads, in the order of
+    submission but filling gaps with later runs (like backfilling). A run
+    becomes eligible queue_delay seconds after all its dependencies finished;
+    runs not submitted in this invocation are taken as finished at the start.
+    """
+
+    def __init__(self, nodes, cores, queue_delay=0, runtime=None, history=None):
         Executor.__init__(self)
+        self.nodes = nodes
+        self.cores = cores
+        self.queue_delay = queue_delay
+        self.runtime = runtime
+        self.history = history or {}
+        self.runs = []  # (name, runtime, threads, dependencies) per task
+        self.tasks = {}  # run id -> index in runs
+        self.arrays = {}  # master id -> list of indices in runs
+        self.submission_count = 0
+
+    def init(self, name, commands, workdir):
+        pass
+
+    def makedirs(self, path):
+        pass
+
+    def open(self):
+        pass
+
+    def store(self, path, content):
+        pass
+
+    def schedule(self, name, run_count, cmd, workdir, dependencies=(), **kwargs):
+        self.scheduled_count += run_count
+        jobname = name.split("(")[0]
+        threads = int(kwargs.get("threads", 1))
+        if threads > self.cores:
+            raise RuntimeError(
+                f"{name} needs {threads} cores, but nodes only have {self.cores}"
+            )
+        slots = kwargs.get("pack_slots")
+        runtime = kwargs.get("runtime")
+        if runtime is None:
+            runtime = self.history.get(jobname, self.runtime)
+        if runtime is not None:
+            if slots is not None:  # packed runs take turns on the slots
+                runtime *= -(-run_count // slots)
+        else:
+            runtime = kwargs["pyslurm_options"]["time_limit"] * 60
+        run_id = f"sim{self.submission_count}"
+        self.submission_count += 1
+        task_dependencies = kwargs.get("task_dependencies")
+        if task_dependencies is None:
+            task_dependencies = [dependencies] * (1 if slots else run_count)
+        indices = []
+        for i, deps in enumerate(task_dependencies):
+            resolved = set()
+            for d in deps:
+                d = str(d).strip()
+                if d in self.tasks:
+                    resolved.add(self.tasks[d])
+                elif d in self.arrays:
+                    resolved.update(self.arrays[d])
+            indices.append(len(self.runs))
+            self.runs.append((name, runtime, threads, resolved))
+        if slots is not None:  # one allocation for all packed runs
+            self.tasks[run_id] = indices[0]
+            for i in range(run_count):
+                self.tasks[pack_member_id(run_id, i)] = indices[0]
+        elif kwargs.get("task_dependencies") is None and run_count == 1:
+            self.tasks[run_id] = indices[0]
+        else:
+            self.arrays[run_id] = indices
+            for i, index in enumerate(indices):
+                self.tasks[array_task_id(run_id, i)] = index
+        return run_id
+
+    def critical_path(self):
+        """Longest chain of dependent runs, i.e. the makespan on an infinite cluster"""
+        finish = []
+        predecessor = []
+        for name, runtime, threads, deps in self.runs:  # submitted in dependency order
+            start = self.queue_delay
+            pred = None
+            for d in deps:
+                if finish[d] + self.queue_delay > start:
+                    start = finish[d] + self.queue_delay
+                    pred = d
+            finish.append(start + runtime)
+            predecessor.append(pred)
+        path = []
+        index = max(range(len(finish)), key=lambda i: finish[i], default=None)
+        length = finish[index] if index is not None else 0
+        while index is not None:
+            path.append(index)
+            index = predecessor[index]
+        return length, path[::-1]
+
+    def simulate(self):
+        """Returns start and end times of all runs and peak concurrency"""
+        starts = [None] * len(self.runs)
+        ends = [None] * len(self.runs)
+        missing = [len(deps) for _, _, _, deps in self.runs]
+        dependents = [[] for _ in self.runs]
+        for i, (_, _, _, deps) in enumerate(self.runs):
+            for d in deps:
+                dependents[d].append(i)
+        eligible = [(self.queue_delay, i) for i, m in enumerate(missing) if not m]
+        heapq.heapify(eligible)
+        queued = []  # eligible runs not yet started, in submission order
+        running = []  # (end, index, node)
+        free = [self.cores] * self.nodes
+        peak_runs = peak_cores = 0
+        now = 0
+        while eligible or queued or running:
+            while eligible and eligible[0][0] <= now:
+                bisect.insort(queued, heapq.heappop(eligible)[1])
+            started = []
+            for i in queued:
+                most_free = max(free)
+                if not most_free:
+                    break
+                threads = self.runs[i][2]
+                if threads > most_free:
+                    continue
+                node = free.index(most_free)
+                free[node] -= threads
+                starts[i] = now
+                heapq.heappush(running, (now + self.runs[i][1], i, node))
+                started.append(i)
+            if started:
+                queued = [i for i in queued if starts[i] is None]
+                peak_runs = max(peak_runs, len(running))
+                peak_cores = max(peak_cores, self.nodes * self.cores - sum(free))
+            now = min(
+                running[0][0] if running else float("inf"),
+                eligible[0][0] if eligible else float("inf"),
+            )
+            while running and running[0][0] <= now:
+                end, i, node = heapq.heappop(running)
+                ends[i] = end
+                free[node] += self.runs[i][2]
+                for j in dependents[i]:
+                    missing[j] -= 1
+                    if not missing[j]:
+                        heapq.heappush(eligible, (end + self.queue_delay, j))
+        return starts, ends, peak_runs, peak_cores
+
+    def close(self):
+        starts, ends, peak_runs, peak_cores = self.simulate()
+        length, path = self.critical_path()
+        tprint("Simulated {} runs".format(self.scheduled_count))
+        tprint(
+            "Cluster: {} nodes with {} cores, queue delay {}".format(
+                self.nodes, self.cores, format_duration(self.queue_delay)
+            )
+        )
+        tprint("Makespan: {}".format(format_duration(max(ends, default=0))))
+        tprint("Critical path: {}".format(format_duration(length)))
+        for i in path:
+            name, runtime, threads, _ = self.runs[i]
+            tprint("    {:>10}  {}".format(format_duration(runtime), name))
+        tprint("Peak concurrency: {} runs on {} cores".format(peak_runs, peak_cores))
+
+
+class SlurmExecutor(Executor):
+    def __init__(self, submission_delay, submission_threads=1, init_threads=1):
+        Executor.__init__(self, init_threads)
         self.submission_delay = submission_delay
+        self.submission_threads = submission_threads
+        self.array_size = None
+        self.array_sizes = {}  # master id -> number of tasks of submitted arrays
         self.progressbar = None
+        self.pool = None
+        self.futures = []
+        self.next_submission = 0
+        self.rate_lock = threading.Lock()
+        self.prompt_lock = threading.Lock()
+        self.pyslurm_lock = threading.Lock()
 
     def close(self):
+        wait(self.futures)
+        self.pool.shutdown()
         self.progressbar.close()
-
-    def init(self, name, cmd, workdir):
-        subprocess.check_output(cmd, shell=not isinstance(cmd, list), cwd=workdir)
+        self.close_inits()
+        for f in self.futures:
+            f.result()  # raise first submission error, if any
 
     def open(self):
-        self.progressbar = tqdm(unit="j", desc="Scheduling")
+        from tqdm import tqdm
 
-    def schedule(self, name, run_count, cmd, workdir, **kwargs):
+        load_pyslurm()  # before submitting from several threads
+        self.progressbar = tqdm(unit="j", desc="Scheduling")
+        self.pool = ThreadPoolExecutor(max_workers=self.submission_threads)
+
+    def max_array_size(self):
+        if self.array_size is None:
+            pyslurm = load_pyslurm()
+            if pyslurm is not None:
+                self.array_size = int(pyslurm.config().get()["max_array_sz"])
+            else:
+                config = subprocess.check_output(["scontrol", "show", "config"])
+                for line in config.decode("utf8").split("\n"):
+                    if line.startswith("MaxArraySize"):
+                        self.array_size = int(line.split("=")[1])
+                        break
+                else:
+                    raise RuntimeError("Could not determine MaxArraySize")
+        return self.array_size
+
+    def schedule(self, name, run_count, cmd, workdir, dependencies=(), **kwargs):
+        """Queues a submission and returns its pending run id
+
+        The submission itself is only started once the run ids of all its
+        dependencies are known.
+        """
         self.scheduled_count += run_count
-        self.progressbar.update(run_count)
-
-        if USE_PYSLURM:
-            try:
-                options = kwargs["pyslurm_options"]
-                options["wrap"] = cmd
-                run_id = pyslurm.job().submit_batch_job(options)
-            except SystemExit as e:
-                if e.code:
-                    raise RuntimeError("Job submission failed")
+        future = self.defer(
+            self.pool,
+            dependencies,
+            self._submit,
+            run_count,
+            cmd,
+            dependencies,
+            kwargs.get("task_dependencies"),
+            kwargs.get("pyslurm_options"),
+            wait_for=kwargs.get("wait_for", ()),
+        )
+        future.add_done_callback(lambda f: self.progressbar.update(run_count))
+        self.futures.append(future)
+        return PendingRunId(future)
+
+    def _wait_for_slot(self):
+        """Limits submissions to one per submission_delay across all threads"""
+        with self.rate_lock:
+            now = time.monotonic()
+            delay = self.next_submission - now
+            self.next_submission = max(now, self.next_submission) + self.submission_delay
+        if delay > 0:
+            time.sleep(delay)
+
+    def _submit(self, run_count, cmd, dependencies, task_dependencies, pyslurm_options):
+        dependency = dependency_string(
+            dependencies, task_dependencies, self.array_sizes
+        )
+        self._wait_for_slot()
+
+        pyslurm = load_pyslurm()
+        if pyslurm is not None:
+            with self.pyslurm_lock:  # libslurm is not thread-safe
+                try:
+                    options = dict(pyslurm_options)
+                    options["dependency"] = dependency
+                    options["wrap"] = cmd
+                    run_id = pyslurm.job().submit_batch_job(options)
+                except SystemExit as e:
+                    if e.code:
+                        raise RuntimeError("Job submission failed")
+            if task_dependencies is not None:
+                self.array_sizes[str(run_id)] = run_count
             return str(run_id)
 
+        args = ["sbatch", "--parsable"]
+        if dependency:
+            args.append(f"--dependency={dependency}")
         while True:
             p = subprocess.Popen(
-                ["sbatch", "--parsable"],
+                args,
                 stdin=subprocess.PIPE,
                 stdout=subprocess.PIPE,
                 bufsize=4096,
@@ -120,34 +632,117 @@ class SlurmExecutor(Executor):
             run_id = p.stdout.read().decode("utf8").strip()
             if not p.wait():
                 break
-            input("Press enter...")
-        time.sleep(self.submission_delay)
+            with self.prompt_lock:
+                input("Press enter...")
+        if task_dependencies is not None:
+            self.array_sizes[run_id] = run_count
         return run_id
 
 
 class LocalExecutor(Executor):
-    def __init__(self):
-        Executor.__init__(self)
+    """Runs jobs on the local machine, independent runs in parallel
+
+    Each run reserves as many of the given cores as it has threads.
+    """
+
+    def __init__(self, cores=None, init_threads=1):
+        Executor.__init__(self, init_threads)
+        self.cores = cores if cores else os.cpu_count()
+        self.free_cores = self.cores
+        self.cores_available = threading.Condition()
         self.progressbar = None
+        self.pool = None
+        self.futures = []
+        self.failed = []
 
     def close(self):
+        wait(self.futures)
+        self.pool.shutdown()
         self.progressbar.close()
-
-    def init(self, name, cmd, workdir):
-        subprocess.check_output(cmd, shell=not isinstance(cmd, list), cwd=workdir)
+        self.close_inits()
+        if self.failed:
+            raise RuntimeError(
+                "{} runs failed:\n    {}".format(
+                    len(self.failed), "\n    ".join(self.failed)
+                )
+            )
 
     def open(self):
+        from tqdm import tqdm
+
         self.progressbar = tqdm(unit="j", desc="Running")
+        self.pool = ThreadPoolExecutor(max_workers=self.cores)
 
-    def schedule(self, name, run_count, cmd, workdir, **kwargs):
+    def schedule(
+        self, name, run_count, cmd, workdir, dependencies=(), threads=1, **kwargs
+    ):
         self.scheduled_count += run_count
-        self.progressbar.update(run_count)
-        print()
-        proc = subprocess.Popen(
-            ["bash", "-e"], stdin=subprocess.PIPE, bufsize=4096, cwd=workdir
+        threads = min(int(threads), self.cores)
+        output = kwargs.get("output", os.devnull)
+        index = len(self.futures)
+        if (run_count == 1 or "pack_slots" in kwargs) and "%a" not in output:
+            tasks = [
+                (
+                    output.replace("%j", f"local{index}"),
+                    {"SLURM_JOB_ID": f"local{index}"},
+                )
+            ]
+        else:
+            tasks = [
+                (
+                    output.replace("%A", f"local{index}").replace("%a", str(i)),
+                    {"SLURM_ARRAY_TASK_ID": str(i)},
+                )
+                for i in range(run_count)
+            ]
+        task_dependencies = kwargs.get("task_dependencies") or [dependencies] * len(
+            tasks
         )
-        proc.stdin.write(bytes(cmd, "utf8"))
-        proc.stdin.close()
-        if proc.wait():
-            raise RuntimeError("job failed")
+        task_futures = [
+            self.defer(
+                self.pool,
+                deps,
+                self._run,
+                name,
+                cmd,
+                workdir,
+                threads,
+                output,
+                env,
+                wait_for=kwargs.get("wait_for", ()),
+            )
+            for (output, env), deps in zip(tasks, task_dependencies)
+        ]
+        future = self.gather(task_futures)
+        future.add_done_callback(lambda f: self.progressbar.update(run_count))
+        self.futures.append(future)
+        if len(tasks) > 1:
+            return PendingRunId(future, task_futures=task_futures)
+        return PendingRunId(future)
+
+    def _run(self, name, cmd, workdir, threads, output, env):
+        with self.cores_available:
+            self.cores_available.wait_for(lambda: self.free_cores >= threads)
+            self.free_cores -= threads
+        try:
+            with open(output, "w") as f:
+                proc = subprocess.Popen(
+                    ["bash", "-e"],
+                    stdin=subprocess.PIPE,
+                    stdout=f,
+                    stderr=subprocess.STDOUT,
+                    bufsize=4096,
+                    cwd=workdir,
+                    env=dict(os.environ, **env),
+                )
+                proc.stdin.write(bytes(cmd, "utf8"))
+                proc.stdin.close()
+                if proc.wait():
+                    self.failed.append(f"{name} (see {output})")
+                    tprint(f"FAILED {name}")
+                    raise RuntimeError("job failed")
+        finally:
+            with self.cores_available:
+                self.free_cores += threads
+                self.cores_available.notify_all()
         return "local"
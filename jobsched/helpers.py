@@ -15,7 +15,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import fnmatch
+import hashlib
 import os
+import re
+import shlex
+from collections import namedtuple
+from functools import lru_cache
+from glob import has_magic
+
+from .profiling import PROFILER
 
 
 def deepupdate(base, new):
@@ -45,9 +54,178 @@ def ensure_abspath(path, relpath):
     return os.path.abspath(path)
 
 
+Script = namedtuple("Script", ["code", "codetype", "sha1"])
+
+SCRIPT_CODETYPES = {".sh": "shell", ".py": "python", ".py3": "python"}
+
+
+class ScriptCache:
+    """Caches script files, which are only read again if their mtime changed"""
+
+    def __init__(self, directory="scripts"):
+        self.directory = directory
+        self.scripts = {}  # filename -> (mtime, Script)
+
+    def get(self, filename):
+        """Returns Script with code, code type (None if unknown) and SHA1 of file"""
+        path = os.path.join(self.directory, filename)
+        mtime = os.stat(path).st_mtime_ns
+        cached = self.scripts.get(filename)
+        PROFILER.cache("script file", cached is not None and cached[0] == mtime)
+        if cached is None or cached[0] != mtime:
+            with open(path, "r") as f:
+                code = f.read()
+            script = Script(
+                code,
+                SCRIPT_CODETYPES.get(os.path.splitext(filename)[1]),
+                hashlib.sha1(code.encode()).hexdigest(),
+            )
+            cached = (mtime, script)
+            self.scripts[filename] = cached
+        return cached[1]
+
+
+def shell_quote(value):
+    """Quotes value for bash such that it stays on a single line"""
+    value = str(value)
+    if "\n" in value or "\r" in value:
+        return "$'{}'".format(
+            value.replace("\\", "\\\\")
+            .replace("'", "\\'")
+            .replace("\n", "\\n")
+            .replace("\r", "\\r")
+        )
+    return shlex.quote(value)
+
+
 def get_setting(settings: dict, name: str, default=None):
     if name in settings:
         return settings[name]
     if default is not None:
         return default
     raise RuntimeError(f"Setting '{name}' required")
+
+
+@lru_cache(maxsize=None)
+def compile_regexp(pattern):
+    return re.compile(pattern)
+
+
+PROFILER.register_lru_cache("regexp", compile_regexp)
+
+
+@lru_cache(maxsize=None)
+def file_digest(path, size, mtime_ns):
+    """SHA-1 of the contents of a file, read once per path, size and mtime"""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+PROFILER.register_lru_cache("file_digest", file_digest)
+
+
+@lru_cache(maxsize=None)
+def load_pyslurm():
+    """Returns the pyslurm module, None if not available (warning only once)"""
+    try:
+        import pyslurm
+
+        return pyslurm
+    except ImportError:
+        print("WARNING: Not using pyslurm")
+        return None
+
+
+@lru_cache(maxsize=None)
+def load_numpy():
+    """Returns the numpy module, None if not available"""
+    try:
+        import numpy
+
+        return numpy
+    except ImportError:
+        return None
+
+
+def load_yaml(stream):
+    """Loads YAML without keeping comments and formatting, but faster than
+    round-trip loading (using the C parser if available)"""
+    from ruamel import yaml
+
+    return yaml.YAML(typ="safe").load(stream)
+
+
+def round_trip_load_yaml(stream):
+    """Loads YAML keeping comments and formatting"""
+    from ruamel import yaml
+
+    return yaml.YAML().load(stream)
+
+
+def round_trip_dump_yaml(data):
+    """Returns data as YAML string, keeping comments and formatting of data
+    loaded with round_trip_load_yaml"""
+    from io import StringIO
+
+    from ruamel import yaml
+
+    stream = StringIO()
+    yaml.YAML().dump(data, stream)
+    return stream.getvalue()
+
+
+class DirectoryCache:
+    """Caches directory listings so that every directory is only listed once"""
+
+    def __init__(self):
+        self.listings = {}
+
+    def entries(self, path):
+        PROFILER.cache("directory listing", path in self.listings)
+        if path not in self.listings:
+            try:
+                with os.scandir(path) as it:
+                    self.listings[path] = {e.name: e for e in it}
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                self.listings[path] = {}
+        return self.listings[path]
+
+    def mtime(self, path):
+        """Modification time of path from the cached listing, None if missing"""
+        directory, name = os.path.split(path)
+        entry = self.entries(directory).get(name)
+        if entry is None:
+            return None
+        try:
+            return entry.stat().st_mtime
+        except FileNotFoundError:  # e.g. broken link
+            return None
+
+    def glob(self, pattern):
+        """Like glob.glob for absolute patterns, but using the cached listings"""
+        paths = ["/"]
+        components = [c for c in pattern.split("/") if c]
+        for i, component in enumerate(components):
+            last = i == len(components) - 1
+            new = []
+            if has_magic(component):
+                r = compile_regexp(fnmatch.translate(component))
+                for path in paths:
+                    for name, entry in self.entries(path).items():
+                        if name[0] == "." and component[0] != ".":
+                            continue
+                        if r.match(name) and (last or entry.is_dir()):
+                            new.append(os.path.join(path, name))
+            else:
+                for path in paths:
+                    if (
+                        not last
+                        or component in [".", ".."]
+                        or component in self.entries(path)
+                    ):
+                        new.append(os.path.join(path, component))
+            paths = new
+        return paths
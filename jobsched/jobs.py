@@ -17,27 +17,31 @@
 
 import hashlib
 import itertools
+import json
 import os
 import re
-import subprocess
+import sys
 from copy import deepcopy
 
-from ruamel import yaml
-
-from .executors import Executor
-from .helpers import deepupdate, ensure_abspath, get_setting
+from .executors import Executor, PendingRunId, array_task_id, pack_member_id
+from .helpers import (
+    DirectoryCache,
+    ScriptCache,
+    deepupdate,
+    ensure_abspath,
+    file_digest,
+    get_setting,
+    round_trip_dump_yaml,
+    shell_quote,
+)
 from .parameters import ParameterCombinations, ParameterValues
+from .plan import PlannedRun, PlannedSubmission, RunGraph, expand
+from .profiling import PROFILER
+from .states import JobState, RunStates
 from .templates import render
 
-try:
-    import pyslurm
-
-    USE_PYSLURM = True
-except ImportError:
-    print("WARNING: Not using pyslurm")
-    USE_PYSLURM = False
-
 VALID_JOB_PROPERTIES = [
+    "array",
     "code",
     "depends",
     "epilog",
@@ -66,62 +70,6 @@ VALID_SETTINGS = [
 SPECIAL_PARAM_PREFIX = "_"
 
 
-class JobState:
-    DONE = 0
-    WAITING = 1
-    FAILED = 2
-    RUNNING = 3
-
-
-SLURM_JOB_STATE_IDS = {
-    0: JobState.WAITING,  # JOB_PENDING
-    1: JobState.RUNNING,  # JOB_RUNNING
-    2: JobState.WAITING,  # JOB_SUSPENDED
-    3: JobState.DONE,  # JOB_COMPLETE
-    4: JobState.FAILED,  # JOB_CANCELLED
-    5: JobState.FAILED,  # JOB_FAILED
-    6: JobState.FAILED,  # JOB_TIMEOUT
-    7: JobState.FAILED,  # JOB_NODE_FAIL
-    8: JobState.WAITING,  # JOB_PREEMPTED
-    10: JobState.FAILED,  # JOB_BOOT_FAIL
-    11: JobState.FAILED, # Cancelled because of memory
-}
-
-def get_run_state(run_id: str):
-    run_id = run_id.strip()
-    if run_id == "local" or run_id == "debug":
-        return JobState.DONE
-
-    if USE_PYSLURM:
-        res = pyslurm.slurmdb_jobs().get(jobids=[run_id])[int(run_id)]["state"]
-        return SLURM_JOB_STATE_IDS[res]
-
-    while True:
-        p = subprocess.Popen(
-            ["sacct", "-j", str(run_id), "-nP", "-o", "state"], stdout=subprocess.PIPE
-        )
-        res = p.stdout.read().decode("utf8").split("\n")[0].strip()
-        if not p.wait():
-            break
-        input("Press enter...")
-    if not res:  # waiting array
-        return JobState.WAITING
-    if res == "PENDING":
-        return JobState.WAITING
-    if res == "RUNNING":
-        return JobState.RUNNING
-    if (
-        res == "FAILED"
-        or res == "CANCELLED"
-        or res == "TIMEOUT"
-        or res == "OUT_OF_MEMORY"
-    ):
-        return JobState.FAILED
-    if res == "COMPLETED":
-        return JobState.DONE
-    raise RuntimeError(f"Unknown job state '{res}'")
-
-
 def to_minutes(time_str: str):
     m = re.match("([0-9]+)-([0-9][0-9]):([0-9][0-9]):([0-9][0-9])", time_str)
     if m:
@@ -144,6 +92,12 @@ def to_minutes(time_str: str):
     raise RuntimeError(f"Invalid time format '{time_str}'")
 
 
+def from_minutes(minutes: int):
+    return "{}-{:02d}:{:02d}:00".format(
+        minutes // (24 * 60), minutes // 60 % 24, minutes % 60
+    )
+
+
 def run_description(current, ignore=None):
     if ignore is None:
         ignore = []
@@ -171,6 +125,10 @@ class JobList:
         self.former_runs = former_runs
         self.jobdescs = get_setting(self.settings, "jobs")
         self.jobs = {}
+        self.run_states = RunStates(self.settings.get("logdir"))
+        self.directories = DirectoryCache()
+        self.scripts = ScriptCache()
+        self.inherited = set()  # names of jobs with inheritance resolved
 
     def get_jobdesc(self, jobname: str):
         if not jobname in self.jobdescs:
@@ -180,12 +138,25 @@ class JobList:
     def get_job(self, jobname: str, combinations: ParameterCombinations):
         self._add_inheritance(jobname)
         self._add_filecombinations(jobname, combinations, set([]))
-        return self._setup_job(jobname)
+        job = self._setup_job(jobname)
+        self._resolve_run_states()
+        return job
 
+    @PROFILER.timed("_add_inheritance")
     def _add_inheritance(self, jobname: str):
+        return expand(self._inheritance_tree(jobname))
+
+    def _inheritance_tree(self, jobname: str):
+        """Generator resolving inheritance of job and its dependencies
+
+        Run by plan.expand, so that long chains of jobs need no recursion.
+        """
         jobdesc = self.get_jobdesc(jobname)
+        if jobname in self.inherited:
+            return jobdesc
+        self.inherited.add(jobname)
         if "inherits" in jobdesc:
-            parent = self._add_inheritance(jobdesc["inherits"])
+            parent = yield self._inheritance_tree(jobdesc["inherits"])
             for k, v in deepcopy(parent).items():
                 if k in jobdesc:
                     jobdesc[k] = deepupdate(v, jobdesc[k])
@@ -193,41 +164,174 @@ class JobList:
                     jobdesc[k] = v
             del jobdesc["inherits"]
         for s in jobdesc.get("depends", []):
-            self._add_inheritance(s["job"])
+            yield self._inheritance_tree(s["job"])
         return jobdesc
 
     def _add_filecombinations(
         self, jobname: str, combinations: ParameterCombinations, seen: set
     ):
+        expand(self._filecombinations_tree(jobname, combinations, seen))
+
+    def _filecombinations_tree(
+        self, jobname: str, combinations: ParameterCombinations, seen: set
+    ):
+        """Generator adding file combinations of dependencies and then job"""
+        if jobname in seen:
+            return
+        seen.add(jobname)
         jobdesc = self.get_jobdesc(jobname)
         for s in jobdesc.get("depends", []):
-            self._add_filecombinations(s["job"], combinations, seen)
-
-        if not jobname in seen:
-            for filepattern in jobdesc.get("foreach", []):
-                combinations.add_filecombinations(
-                    filepattern,
-                    get_setting(self.settings, "workdir"),
-                    self.constants,
-                    jobdesc.get("parameters", {}),
+            yield self._filecombinations_tree(s["job"], combinations, seen)
+
+        for filepattern in jobdesc.get("foreach", []):
+            combinations.add_filecombinations(
+                filepattern,
+                get_setting(self.settings, "workdir"),
+                self.constants,
+                jobdesc.get("parameters", {}),
+                listing=self.directories,
+            )
+
+    @PROFILER.timed("plan")
+    def plan(self, job, combinations: ParameterCombinations, forcestart=False):
+        """Plans the runs of job and its dependencies which are to be submitted"""
+        graph = RunGraph(
+            job.name,
+            {k: self.settings.get(k) for k in ["account", "logdir", "workdir"]},
+        )
+        expand(job.plan_tree(graph, combinations, {}, forcestart))
+        # dependencies first, as runs depending on the same arrays are grouped
+        for jobname in dict.fromkeys(node.job for node in graph.nodes):
+            pack_size = self.jobs[jobname].pack_size()
+            array_size = self.jobs[jobname].auto_array_size()
+            if pack_size:
+                graph.pack(jobname, pack_size)
+            elif array_size:
+                graph.group_arrays(jobname, array_size)
+        return graph
+
+    @PROFILER.timed("submit")
+    def submit(self, graph: RunGraph):
+        """Submits planned runs in topological order and records them"""
+        for jobname, plan_hash in graph.definitions.items():
+            self._add_inheritance(jobname)
+            if self._setup_job(jobname).plan_hash() != plan_hash:
+                raise RuntimeError(f"Job '{jobname}' changed since planning")
+        for node in graph.nodes:
+            job = self.jobs[node.job]
+            for task in node.tasks:
+                previous = job.former_runs.get(task["current"], {}).get("id")
+                if str(previous) != str(task["previous"]):
+                    raise RuntimeError(
+                        "{}({}) recorded as {} since planning".format(
+                            job.name, task["current"], previous
+                        )
+                    )
+
+        run_ids = []
+
+        def resolve(run_id):
+            if not isinstance(run_id, PlannedRun):
+                return run_id
+            if run_id.task is None:
+                return run_ids[run_id.node]
+            if graph.nodes[run_id.node].pack:
+                return pack_member_id(run_ids[run_id.node], run_id.task)
+            return array_task_id(run_ids[run_id.node], run_id.task)
+
+        for node in graph.nodes:
+            job = self.jobs[node.job]
+            init_futures = []
+            for task in node.tasks:
+                self.executor.makedirs(task["workdir"])
+                init_futures.append(
+                    job.init_run(task["current"], task["init"], task["workdir"])
                 )
-        seen.add(jobname)
+            dependencies = [
+                [resolve(d) for d in task["dependencies"]] for task in node.tasks
+            ]
+            if node.array or node.pack:
+                run_id = job.schedule_run(
+                    [task["current"] for task in node.tasks],
+                    [task["parameters"] for task in node.tasks],
+                    dependencies,
+                    [task["workdir"] for task in node.tasks]
+                    if node.pack
+                    else node.tasks[-1]["workdir"],
+                    [task.get("unchanged_inputs") for task in node.tasks]
+                    if node.pack
+                    else None,
+                    set(itertools.chain(*init_futures)),
+                    array=node.array,
+                    pack=node.pack,
+                )
+                member_id = pack_member_id if node.pack else array_task_id
+                task_run_ids = [member_id(run_id, i) for i in range(len(node.tasks))]
+            else:
+                task = node.tasks[0]
+                run_id = job.schedule_run(
+                    task["current"],
+                    task["parameters"],
+                    dependencies[0],
+                    task["workdir"],
+                    task.get("unchanged_inputs"),
+                    init_futures[0],
+                )
+                task_run_ids = [run_id]
+            run_ids.append(run_id)
+            for task, task_run_id in zip(node.tasks, task_run_ids):
+                job.former_runs[task["current"]] = dict(task["record"], id=task_run_id)
+                job.scheduled_runs[task["current"]] = task_run_id
+                job.scheduled_ids.add(task_run_id)
+
+    def resolve_run_ids(self):
+        """Replaces pending run ids of submitted runs by the actual ones
+
+        Runs whose submission failed are forgotten, such that they are
+        scheduled again by the next invocation.
+        """
+        for job in self.jobs.values():
+            for c, run_id in list(job.scheduled_runs.items()):
+                if isinstance(run_id, PendingRunId):
+                    if run_id.future.exception() is not None:
+                        del job.scheduled_runs[c]
+                        del job.former_runs[c]
+                        continue
+                    job.scheduled_runs[c] = str(run_id)
+                    job.former_runs[c]["id"] = job.scheduled_runs[c]
+
+    def _resolve_run_states(self):
+        """Resolves states of all unfinished former runs with batched queries"""
+        self.run_states.resolve_all(
+            info for job in self.jobs.values() for info in job.former_runs.values()
+        )
 
     def _setup_job(self, jobname: str):
+        return expand(self._setup_tree(jobname))
+
+    def _setup_tree(self, jobname: str):
+        """Generator setting up dependencies and then job, returning the job"""
         if jobname in self.jobs:
             return self.jobs[jobname]
         jobdesc = self.get_jobdesc(jobname)
-        dependencies = [
-            (self._setup_job(s["job"]), s["foreach"])
-            for s in jobdesc.get("depends", [])
-        ]
+        dependencies = []
+        for s in jobdesc.get("depends", []):
+            dependencies.append(((yield self._setup_tree(s["job"])), s["foreach"]))
         if jobname in self.former_runs:
             former_runs = self.former_runs[jobname]
         else:
             former_runs = {}
             self.former_runs[jobname] = former_runs
         job = Job(
-            jobname, jobdesc, dependencies, self.settings, former_runs, self.executor
+            jobname,
+            jobdesc,
+            dependencies,
+            self.settings,
+            former_runs,
+            self.executor,
+            self.run_states,
+            self.directories,
+            self.scripts,
         )
         self.jobs[jobname] = job
         return job
@@ -242,6 +346,9 @@ class Job:
         settings: dict,
         former_runs: dict,
         executor: Executor,
+        run_states: RunStates = None,
+        directories: DirectoryCache = None,
+        scripts: ScriptCache = None,
     ):
 
         for k in jobdesc:
@@ -250,20 +357,17 @@ class Job:
 
         self.executor = executor
         self.name = jobname
+        self.scripts = scripts if scripts is not None else ScriptCache()
 
         if "filename" in jobdesc:
-            if jobdesc["filename"].endswith(".sh"):
-                self.codetype = "shell"
-            elif jobdesc["filename"].endswith(".py") or jobdesc["filename"].endswith(
-                ".py3"
-            ):
-                self.codetype = "python"
-            else:
+            script = self.scripts.get(jobdesc["filename"])
+            if script.codetype is None:
                 raise RuntimeError(
                     "Unknown file extension for {}".format(jobdesc["filename"])
                 )
-            with open("scripts/{}".format(jobdesc["filename"]), "r") as f:
-                self.code = f.read()
+            self.code = script.code
+            self.codetype = script.codetype
+            self.code_hash = script.sha1
         elif "code" in jobdesc:
             self.code = jobdesc["code"]
             self.codetype = "shell"
@@ -271,13 +375,15 @@ class Job:
             self.code = ""
             self.codetype = "shell"
             self.time = "0:00"
+        if "filename" not in jobdesc:
+            self.code_hash = hashlib.sha1(self.code.encode()).hexdigest()
 
         self.variables = set([])
         self.parameters = jobdesc.get("parameters", {})
         self.parameters.update(get_setting(settings, "const", {}))
 
         if "settings" in jobdesc:
-            self.parameters["settings"] = yaml.round_trip_dump(jobdesc["settings"])
+            self.parameters["settings"] = round_trip_dump_yaml(jobdesc["settings"])
 
         for filepattern in jobdesc.get("foreach", []):
             _, missing = render(filepattern, self.parameters, output_missing=True)
@@ -312,69 +418,378 @@ class Job:
 
         self.dependencies = dependencies
         self.former_runs = former_runs
+        self.run_states = run_states if run_states is not None else RunStates()
+        self.directories = directories if directories is not None else DirectoryCache()
         self.scheduled_runs = {}
+        self.scheduled_ids = set()
+        self.checked_runs = set()  # runs found up to date, not to be checked again
+        self.subtrees = {}  # (projected current, forcestart) -> run ids
+        self.run_outputs = {}
+        self.definition_sha1 = None
         self.settings = settings
+        self.script_parts = {}
 
-    def init_run(self, current, parameters, workdir):
-        """Initializes a particular run of a job"""
-        name = "{}({})".format(self.name, current)
+    def init_commands(self, current, parameters):
+        """Returns the rendered init commands of a particular run"""
+        commands = []
         for i in self.init:
             if "code" in i:
                 cmd = i["code"]
             else:
-                with open("scripts/{}".format(i["filename"]), "r") as f:
-                    cmd = f.read()
-            self.executor.init(
-                name, render(cmd, self.parameters, current, parameters), workdir
+                cmd = self.scripts.get(i["filename"]).code
+            commands.append(render(cmd, self.parameters, current, parameters))
+        return commands
+
+    @PROFILER.timed("init_run")
+    def init_run(self, current, commands, workdir):
+        """Initializes a particular run of a job
+
+        Returns the futures of init commands to wait for before submission.
+        """
+        if not commands:
+            return []
+        future = self.executor.init(
+            "{}({})".format(self.name, current), commands, workdir
+        )
+        return [] if future is None else [future]
+
+    def store(self, content, suffix=""):
+        """Stores content in a content-addressed file in the logdir"""
+        path = os.path.join(
+            get_setting(self.settings, "logdir"),
+            "store",
+            hashlib.sha1(content.encode()).hexdigest() + suffix,
+        )
+        self.executor.store(path, content)
+        return path
+
+    def script_part(self, text, codetype, delimiter, parameters):
+        """Returns the command running one part (prolog, code, epilog) of the script
+
+        Parts which do not depend on the particular run are rendered once and
+        written to the script store, so that submitted scripts only refer to
+        them. Other parts are embedded and rendered along with the script.
+        """
+        interpreter = {"shell": "bash -e", "python": "python3"}[codetype]
+        key = (text, codetype, frozenset(parameters.items()))
+        PROFILER.cache("script part", key in self.script_parts)
+        if key not in self.script_parts:
+            try:
+                rendered, missing = render(
+                    text, self.parameters, parameters, output_missing=True
+                )
+            except Exception:  # e.g. _eval of a missing parameter
+                missing = True
+            if missing:
+                self.script_parts[key] = None
+            elif not rendered.strip():
+                self.script_parts[key] = "true"
+            else:
+                path = self.store(
+                    rendered, {"shell": ".sh", "python": ".py"}[codetype]
+                )
+                if codetype == "python":  # from stdin as embedded, e.g. for sys.path
+                    self.script_parts[key] = "{} - < '{}'".format(interpreter, path)
+                else:
+                    self.script_parts[key] = "{} '{}'".format(interpreter, path)
+        if self.script_parts[key] is None:
+            return "{} <<'{}'\n{}\n{}".format(interpreter, delimiter, text, delimiter)
+        return self.script_parts[key]
+
+    def expected_runtime(self):
+        """Expected runtime of a run in seconds, None if not given
+
+        Set by scheduler setting "runtime", in seconds or as time like "time".
+        """
+        runtime = self.scheduler.get("runtime")
+        if runtime is None or isinstance(runtime, (int, float)):
+            return runtime
+        return to_minutes(str(runtime)) * 60
+
+    def pack_size(self):
+        """Number of runs to submit together in one allocation (0: no packing)
+
+        Packed jobs also need scheduler setting "pack_cores", the number of
+        cores of one allocation (at most one node), which its runs share.
+        """
+        if "pack" not in self.scheduler:
+            return 0
+        if self.array:
+            raise RuntimeError(f"Array job '{self.name}' cannot be packed")
+        if "pack_cores" not in self.scheduler:
+            raise RuntimeError(f"Packed job '{self.name}' needs setting 'pack_cores'")
+        if int(self.scheduler["pack_cores"]) < int(self.scheduler.get("threads", 1)):
+            raise RuntimeError(
+                f"Setting 'pack_cores' of job '{self.name}' less than its threads"
+            )
+        return int(self.scheduler["pack"])
+
+    def auto_array_size(self):
+        """Maximal number of runs to submit as one array automatically (0: never)
+
+        Set by scheduler setting "auto_array" (true for the maximal array
+        size), off by default: as for array jobs, the script is then rendered
+        once with the values of each run read into shell variables, which
+        behaves differently e.g. within single quotes, sections or _eval.
+        """
+        size = self.scheduler.get("auto_array", False)
+        if size is False or self.codetype != "shell":
+            return 0
+        if size is True:
+            return self.max_array_size() or sys.maxsize
+        return min(int(size), self.max_array_size() or sys.maxsize)
+
+    def max_array_size(self):
+        if "array_max_size" in self.scheduler:
+            return int(self.scheduler["array_max_size"])
+        return self.executor.max_array_size()
+
+    def is_up_to_date(self, parameters, workdir):
+        """Checks if all outputs of a run exist and are newer than its inputs"""
+        if not self.output:
+            return False
+        outputs = [
+            self.directories.mtime(ensure_abspath(parameters[f"_output{i}"], workdir))
+            for i in range(len(self.output))
+        ]
+        if None in outputs:
+            return False
+        inputs = [
+            self.directories.mtime(
+                ensure_abspath(
+                    parameters[f"_p{i}"], get_setting(self.settings, "workdir")
+                )
             )
+            for i in range(len(self.foreach))
+        ]
+        if None in inputs:
+            return False
+        return not inputs or min(outputs) >= max(inputs)
+
+    def output_files(self, parameters, workdir):
+        return [
+            ensure_abspath(parameters[f"_output{i}"], workdir)
+            for i in range(len(self.output))
+        ]
 
-    def schedule_run(self, current, parameters, dep_run_ids, workdir):
-        """Schedules a particular run of a job"""
+    def input_files(self, parameters):
+        return [
+            ensure_abspath(parameters[f"_p{i}"], get_setting(self.settings, "workdir"))
+            for i in range(len(self.foreach))
+        ]
 
-        if dep_run_ids is None:
-            dep_run_ids = ""
-        else:
-            dep_run_ids = ":".join(
-                sorted(
-                    set(
-                        run_id.split("_")[0].strip()
-                        for run_id in dep_run_ids
-                        if run_id != "local"
-                    )
-                )
+    def outputs(self, possible, current):
+        """Output files of all runs matching current, as recorded by plan_tree"""
+        current = dict(item for item in current.items() if item[0] in self.variables)
+        combinations = possible.recombine(current, list(self.variables - set(current)))
+        return sorted(
+            itertools.chain.from_iterable(
+                self.run_outputs.get(c, []) for c in combinations
+            )
+        )
+
+    def definition_hash(self):
+        """Hash of the code and parameters of the job"""
+        if self.definition_sha1 is None:
+            self.definition_sha1 = hashlib.sha1(
+                json.dumps(
+                    [
+                        self.codetype,
+                        self.code,
+                        self.prolog,
+                        self.epilog,
+                        {k: v for k, v in self.parameters.items() if k != "_threads"},
+                    ],
+                    sort_keys=True,
+                    default=str,
+                ).encode()
+            ).hexdigest()
+        return self.definition_sha1
+
+    def plan_hash(self):
+        """Hash of the job definition as far as relevant for submitting runs"""
+        return hashlib.sha1(
+            json.dumps(
+                [self.definition_hash(), self.scheduler, self.init, self.array],
+                sort_keys=True,
+                default=str,
+            ).encode()
+        ).hexdigest()
+
+    def fingerprint(self, current, parameters):
+        """Hash of everything determining a run except for its input files"""
+        return hashlib.sha1(
+            json.dumps(
+                [self.definition_hash(), dict(current), parameters],
+                sort_keys=True,
+                default=str,
+            ).encode()
+        ).hexdigest()
+
+    def inputs_stamp(self, inputs):
+        """Cheap stamp of input files (size and mtime), None if any is missing"""
+        stamp = hashlib.sha1()
+        for path in inputs:
+            directory, name = os.path.split(path)
+            entry = self.directories.entries(directory).get(name)
+            if entry is None:
+                return None
+            try:
+                st = entry.stat()
+            except FileNotFoundError:  # e.g. broken link
+                return None
+            stamp.update(f"{path}\0{st.st_size}\0{st.st_mtime_ns}\0".encode())
+        return stamp.hexdigest()
+
+    @staticmethod
+    @PROFILER.timed("inputs_hash")
+    def inputs_hash(inputs):
+        """Hash of the digests of input files, one per line, as computed by
+        `for f in ...; do sha1sum < $f; done | cut -d" " -f1 | sha1sum`
+
+        Files are only read again if their size or mtime changed.
+        """
+        h = hashlib.sha1()
+        for path in inputs:
+            st = os.stat(path)
+            h.update(f"{file_digest(path, st.st_size, st.st_mtime_ns)}\n".encode())
+        return h.hexdigest()
+
+    def inputs_unchanged(self, info, inputs):
+        """Checks if the inputs of a finished run still have the recorded contents
+
+        Inputs with changed stamps but unchanged contents are recorded with
+        their new stamp, so that downstream runs are not rerun (early cutoff).
+        """
+        stamp = self.inputs_stamp(inputs)
+        if stamp is None or stamp == info.get("inputs_stamp"):
+            return True
+        inputs_hash = self.inputs_hash(inputs)
+        if info.get("inputs") not in [None, inputs_hash]:
+            return False
+        info["inputs"] = inputs_hash
+        info["inputs_stamp"] = stamp
+        return True
+
+    def unchanged_check(self, name, unchanged_inputs):
+        """Script lines exiting early if outputs exist and inputs are unchanged"""
+        if unchanged_inputs is None:
+            return ""
+        inputs_hash, inputs, outputs = unchanged_inputs
+        checks = ["[[ -e {} ]]".format(shell_quote(path)) for path in outputs]
+        checks.append(
+            '[[ "$(for f in {}; do sha1sum < "$f"; done | cut -d" " -f1 | sha1sum'
+            ' | cut -d" " -f1)" == {} ]]'.format(
+                " ".join(shell_quote(path) for path in inputs), inputs_hash
             )
+        )
+        return (
+            "if [[ $ret == 0 ]] && {}\n"
+            "then\n"
+            "    echo \"UNCHANGED {} @ $(date +'%FT%T')\"\n"
+            "    exit 0\n"
+            "fi\n"
+        ).format(" && ".join(checks), name)
+
+    @PROFILER.timed("schedule_run")
+    def schedule_run(
+        self,
+        current,
+        parameters,
+        dep_run_ids,
+        workdir,
+        unchanged_inputs=None,
+        init_futures=(),
+        array=None,
+        pack=False,
+    ):
+        """Schedules a particular run of a job
+
+        For arrays and packs, current and parameters are lists with one entry
+        per task and dep_run_ids lists the run ids each task depends on. For
+        packs, workdir and unchanged_inputs are such lists as well. For single
+        runs, unchanged_inputs is an optional tuple (inputs hash, input files,
+        output files) to skip the run if rerunning dependencies reproduced
+        the same inputs. The run is only submitted once its init_futures are
+        done.
+
+        Packed runs share one allocation of scheduler setting "pack_cores"
+        cores, in which a worker runs them in parallel on as many slots as
+        these cores suffice for their threads. The exit code of each run is recorded in <logdir>/<allocation id>.pack.
+        Runs of jobs not marked as array are submitted as one if array is set.
+        """
+        if array is None:
+            array = self.array
+
+        if dep_run_ids is None:
+            dep_run_ids = []
+        task_dep_run_ids = None
 
         template_parameters = {}
+        parameter_names = {}
         array_cmd = ""
+        logdir = get_setting(self.settings, "logdir")
+        threads = self.scheduler.get("threads", 1)
+        cores = threads
+        time_limit = self.scheduler.get("time", "1-00:00:00")
 
-        if self.array:
+        if array or pack:
             if self.codetype != "shell":
-                raise RuntimeError("Arrays only supported for shell jobs")
+                raise RuntimeError("Arrays and packs only supported for shell jobs")
             p = set(current[0].items())
             for p_ in current[1:]:
                 p = set(p & set(p_.items()))
-            name = "{}(len: {}, {})".format(
-                self.name, len(current), ParameterValues(dict(p))
+            name = "{}({}: {}, {})".format(
+                self.name,
+                "pack" if pack else "len",
+                len(current),
+                ParameterValues(dict(p)),
+            )
+            task_dep_run_ids = dep_run_ids
+            dep_run_ids = list(set(itertools.chain(*task_dep_run_ids)))
+            if pack:
+                task_dep_run_ids = None  # the allocation waits for all of them
+                workdirs = workdir
+                workdir = get_setting(self.settings, "workdir")
+                cores = int(self.scheduler["pack_cores"])
+                slots = cores // int(threads)
+                waves = -(-len(current) // slots)
+                time_limit = from_minutes(to_minutes(time_limit) * waves)
+                output = "{}/%j".format(logdir)
+                array_str = ""
+            else:
+                output = "{}/%A-%a".format(logdir)
+                array_str = "0-{}".format(len(parameters) - 1)
+                if "array_size" in self.scheduler:
+                    array_str += "%{}".format(self.scheduler["array_size"])
+            # parameters of each task are read from a table with one line per task
+            table = ""
+            for i, (p, c) in enumerate(zip(parameters, current)):
+                values = dict(p)
+                values.update(c)
+                if pack:
+                    values["_workdir"] = workdirs[i]
+                    values["_unchanged"] = self.unchanged_check(
+                        p["_desc"], unchanged_inputs[i]
+                    )
+                for n in values:
+                    parameter_names[n] = "${{PARAM_{}}}".format(n)
+                assignments = (
+                    "PARAM_{}={}".format(n, shell_quote(v)) for n, v in values.items()
+                )
+                table += "export {}\n".format(" ".join(assignments))
+            table_path = self.store(table, ".params")
+            array_cmd = (
+                'eval "$(awk -v i="{}" '
+                "'NR == i + 1 {{print; exit}}' '{}')\"\n".format(
+                    "$1" if pack else "$SLURM_ARRAY_TASK_ID", table_path
+                )
             )
-            output = "{}/%A-%a".format(get_setting(self.settings, "logdir"))
-            array_str = "0-{}".format(len(parameters) - 1)
-            # if "array_size" in self.settings:
-            #     array_str += "%{}".format(self.settings["array_size"])
-            parameter_names = {}
-            for p in [parameters, current]:
-                if p:
-                    for n in p[0]:
-                        parameter_names[
-                            n
-                        ] = "${{PARAM_{}[$SLURM_ARRAY_TASK_ID]}}".format(n)
-                    for i, nv in enumerate(p):
-                        for n, v in nv.items():
-                            array_cmd += f"export PARAM_{n}[{i}]='{v}'\n"
             template_parameters.update(self.parameters)
             template_parameters.update(parameter_names)
         else:
             name = "{}({})".format(self.name, current)
-            output = "{}/%j".format(get_setting(self.settings, "logdir"))
+            output = "{}/%j".format(logdir)
             array_str = ""
             template_parameters.update(self.parameters)
             template_parameters.update(current)
@@ -385,7 +800,7 @@ class Job:
             "acctg-freq": "energy=0",
             "array": array_str,
             "constraint": self.scheduler.get("constraint", ""),  # e.g. broadwell
-            "cpus-per-task": self.scheduler.get("threads", 1),
+            "cpus-per-task": cores,
             "error": output,
             "export": "ALL",
             "job-name": name,
@@ -396,7 +811,7 @@ class Job:
             "partition": self.scheduler.get("partition", "standard"),
             "profile": "none",
             "qos": self.scheduler.get("qos", "short"),
-            "time": self.scheduler.get("time", "1-00:00:00"),
+            "time": time_limit,
             "workdir": workdir,
         }
 
@@ -405,7 +820,6 @@ class Job:
             "acctg_freq": slurm_options["acctg-freq"],
             "array_inx": slurm_options["array"],
             "constraints": slurm_options["constraint"],
-            "dependency": "afterok:{}".format(dep_run_ids) if dep_run_ids else "",
             "error": slurm_options["error"],
             # "export_env": slurm_options["export"],
             "job_flags": 1,  # KILL_INV_DEP
@@ -432,11 +846,12 @@ class Job:
 
         template_parameters["_slurm_header"] = slurm_header
         template_parameters["_workdir"] = workdir
+        if pack:
+            template_parameters["_workdir"] = "${PARAM__workdir}"
 
         cmd = """\
 #!/bin/bash
 {slurm_header}\
-{dependencies}\
 {array}\
 echo "STARTING {name} @ $(date +'%FT%T')"
 
@@ -445,25 +860,20 @@ export OMP_NUM_THREADS={threads}
 cd "{workdir}"
 
 ret=$?
+{unchanged}\
 if [[ $ret == 0 ]]
 then
-    bash -e <<'PROLOG'
-{prolog}
-PROLOG
+    {prolog}
     ret=$?
 fi
 if [[ $ret == 0 ]]
 then
-    {interpreter} <<'{hash}'
-{code}
-{hash}
+    {code}
     ret=$?
 fi
 if [[ $ret == 0 ]]
 then
-    bash -e <<'EPILOG'
-{epilog}
-EPILOG
+    {epilog}
     ret=$?
 fi
 if [[ $ret == 0 ]]
@@ -476,51 +886,108 @@ exit $ret
 """.format(
             **{
                 "array": array_cmd,
-                "code": self.code,
-                "dependencies": "#SBATCH --depend='afterok:{}'\n".format(dep_run_ids)
-                if dep_run_ids
-                else "",
-                "epilog": self.epilog,
-                "hash": hashlib.sha1(self.code.encode()).hexdigest(),
-                "interpreter": {"shell": "bash -e", "python": "python3"}[self.codetype],
-                "name": name,
-                "prolog": self.prolog,
-                "slurm_header": slurm_header,
-                "threads": slurm_options["cpus-per-task"],
-                "workdir": workdir,
+                "code": self.script_part(
+                    self.code, self.codetype, self.code_hash, parameter_names
+                ),
+                "epilog": self.script_part(
+                    self.epilog, "shell", "EPILOG", parameter_names
+                ),
+                "name": "${PARAM__desc}" if pack else name,
+                "prolog": self.script_part(
+                    self.prolog, "shell", "PROLOG", parameter_names
+                ),
+                "slurm_header": "" if pack else slurm_header,
+                "threads": threads,
+                "unchanged": 'eval "${PARAM__unchanged}"\n'
+                if pack
+                else self.unchanged_check(name, unchanged_inputs),
+                "workdir": "${PARAM__workdir}" if pack else workdir,
             }
         )
 
         cmd = render(cmd, template_parameters)
 
+        if pack:
+            # the worker runs the script above for every packed run
+            cmd = """\
+#!/bin/bash
+{slurm_header}\
+echo "STARTING {name} @ $(date +'%FT%T')"
+
+status="{logdir}/$SLURM_JOB_ID.pack"
+: > "$status"  # all runs start over if requeued
+run() {{
+    bash '{script}' "$1" > "{logdir}/$SLURM_JOB_ID+$1" 2>&1
+    echo "$1 $?" >> "$status"
+}}
+export -f run
+export status
+seq 0 {last} | xargs -P {slots} -n 1 bash -c 'run "$0"'
+
+if [[ "$(awk '$2 == 0' "$status" | wc -l)" == {count} ]]
+then
+    echo "DONE {name} @ $(date +'%FT%T')"
+    exit 0
+else
+    echo "FAILED {name} @ $(date +'%FT%T')"
+    exit 1
+fi
+""".format(
+                count=len(current),
+                last=len(current) - 1,
+                logdir=logdir,
+                name=name,
+                script=self.store(cmd, ".sh"),
+                slots=slots,
+                slurm_header=slurm_header,
+            )
+
         run_id = self.executor.schedule(
             name,
-            len(parameters) if self.array else 1,
+            len(parameters) if array or pack else 1,
             cmd,
             workdir,
+            dependencies=dep_run_ids,
+            task_dependencies=task_dep_run_ids,
+            output=output,
             pyslurm_options=pyslurm_options,
+            threads=slurm_options["cpus-per-task"],
+            runtime=self.expected_runtime(),
+            wait_for=init_futures,
+            **({"pack_slots": slots} if pack else {}),
         )
         return run_id
 
-    def schedule_tree(self, possible, current, forcestart=False):
-        """Schedule dependencies and then job"""
+    def plan_tree(self, graph, possible, current, forcestart=False):
+        """Plans dependencies and then job, adding runs to be submitted to graph
+
+        Generator yielding the planning generators of dependencies (to be run
+        by plan.expand) and returning the run ids or planned runs matching
+        current.
+        """
         current = dict(item for item in current.items() if item[0] in self.variables)
+        key = (frozenset(current.items()), forcestart)
+        PROFILER.cache("subtree", key in self.subtrees)
+        if key in self.subtrees:
+            return list(self.subtrees[key])
         run_ids = []
+        self.subtrees[key] = run_ids
+        graph.definitions[self.name] = self.plan_hash()
         combinations = possible.recombine(current, list(self.variables - set(current)))
-        if self.array:
-            all_combinations = []
-            all_parameters = []
-            all_dependencies = []
+        array_tasks = []
 
         for c in combinations:
+            if c in self.checked_runs:  # found up to date before
+                if c in self.former_runs:
+                    run_ids.append(self.former_runs[c]["id"])
+                continue
+
             if (
                 c in self.former_runs
                 and not c in self.scheduled_runs
                 and not self.former_runs[c].get("success", False)
             ):
-                state = get_run_state(self.former_runs[c]["id"])
-                if state == JobState.DONE:
-                    self.former_runs[c]["success"] = True
+                state = self.run_states.resolve(self.former_runs[c])
             else:
                 state = JobState.DONE
 
@@ -548,68 +1015,105 @@ exit $ret
                 render(self.workdir, c, self.parameters),
                 get_setting(self.settings, "workdir"),
             )
-            if not os.path.exists(workdir):
-                self.executor.init(self.name, ["mkdir", "-p", workdir], ".")
-
-            # output_missing = False
-            # for f in outputfiles.values():
-            #     if os.path.exists(os.path.join(workdir, f)):
-            #         if state not in [
-            #             JobState.FAILED,
-            #             JobState.RUNNING,
-            #             JobState.WAITING,
-            #             JobState.DONE,
-            #         ] and (
-            #             not c in self.former_runs
-            #             or not self.former_runs[c].get("success", False)
-            #         ):
-            #             tprint(f"Warning: File {f} already exists")
-            #     else:
-            #         output_missing = True
 
             parameters.update(outputfiles)
-
-            # if not (state == JobState.DONE and c in self.former_runs) and not output_missing and not forcestart:
-            #    tprint("Output present for {}".format(parameters["_desc"]))
-            #    if not c in self.former_runs:
-            #        self.former_runs[c] = {}
-            #    self.former_runs[c]["success"] = True
-            #    continue
+            self.run_outputs[c] = self.output_files(parameters, workdir)
 
             # still_running = c in self.scheduled_runs or state in [JobState.RUNNING, JobState.WAITING]
             has_failed = state == JobState.FAILED
             already_scheduled = c in self.former_runs or c in self.scheduled_runs
+            # finished runs recorded with a fingerprint are checked for changes
+            memoized = (
+                already_scheduled
+                and not c in self.scheduled_runs
+                and state == JobState.DONE
+                and "fingerprint" in self.former_runs[c]
+            )
 
-            if has_failed or forcestart or not already_scheduled:
+            if has_failed or forcestart or not already_scheduled or memoized:
                 # if state != JobState.FAILED:
-                self.init_run(c, parameters, workdir)
                 dep_run_ids = []
+                upstream_scheduled = False
+                inputs = self.input_files(parameters)
                 for dep, foreach in self.dependencies:
-                    dep_run_ids += dep.schedule_tree(
-                        possible, {k: v for k, v in c.items() if k in foreach}
-                    )
+                    dep_current = {k: v for k, v in c.items() if k in foreach}
+                    ids = yield dep.plan_tree(graph, possible, dep_current)
+                    upstream_scheduled |= any(r in dep.scheduled_ids for r in ids)
+                    dep_run_ids += ids
+                    inputs += dep.outputs(possible, dep_current)
+                fingerprint = self.fingerprint(c, parameters)
+                unchanged_inputs = None
+
+                if has_failed:
+                    reason = "failed"
+                elif forcestart:
+                    reason = "forced"
+                elif memoized:
+                    info = self.former_runs[c]
+                    if info["fingerprint"] != fingerprint:
+                        reason = "changed definition"
+                    elif not upstream_scheduled:
+                        if self.inputs_unchanged(info, inputs):
+                            self.checked_runs.add(c)
+                            run_ids.append(info["id"])
+                            continue
+                        reason = "changed inputs"
+                    else:
+                        reason = "dependencies rerun"
+                        if info.get("inputs") and inputs and not self.array:
+                            # skip at runtime if upstream reproduces the same inputs
+                            unchanged_inputs = (
+                                info["inputs"],
+                                inputs,
+                                self.run_outputs[c],
+                            )
+                elif upstream_scheduled:
+                    reason = "new"
+                elif self.is_up_to_date(parameters, workdir):
+                    self.checked_runs.add(c)
+                    continue
+                else:
+                    reason = "new"
+
+                record = {"success": False, "fingerprint": fingerprint}
+                if not upstream_scheduled:
+                    stamp = self.inputs_stamp(inputs)
+                    if stamp is not None:
+                        record["inputs"] = self.inputs_hash(inputs)
+                        record["inputs_stamp"] = stamp
+
+                task = {
+                    "current": c,
+                    "parameters": parameters,
+                    "workdir": workdir,
+                    "dependencies": dep_run_ids,
+                    "init": self.init_commands(c, parameters),
+                    "reason": reason,
+                    "record": record,
+                    "previous": self.former_runs.get(c, {}).get("id"),
+                    "unchanged_inputs": unchanged_inputs,
+                }
                 if self.array:
-                    all_combinations.append(c)
-                    all_parameters.append(parameters)
-                    all_dependencies.append(dep_run_ids)
+                    array_tasks.append(task)
                 else:
-                    run_id = self.schedule_run(c, parameters, dep_run_ids, workdir)
+                    node = PlannedSubmission(self.name, False)
+                    node.tasks.append(task)
+                    run_id = PlannedRun(graph.add(node))
                     run_ids.append(run_id)
-                    self.former_runs[c] = {"id": run_id, "success": False}
                     self.scheduled_runs[c] = run_id
+                    self.scheduled_ids.add(run_id)
             else:
                 run_ids.append(self.former_runs[c]["id"])
 
-        if self.array and all_combinations:
-            run_id = self.schedule_run(
-                all_combinations,
-                all_parameters,
-                set(itertools.chain(*all_dependencies)),
-                workdir,
-            )
-            for i, c in enumerate(all_combinations):
-                array_run_id = f"{run_id}_{i}"
-                self.former_runs[c] = {"id": array_run_id, "success": False}
-                self.scheduled_runs[c] = array_run_id
-            run_ids.append(run_id)
+        if array_tasks:
+            size = self.max_array_size() or len(array_tasks)
+            for start in range(0, len(array_tasks), size):
+                node = PlannedSubmission(self.name, True)
+                node.tasks = array_tasks[start : start + size]
+                index = graph.add(node)
+                for i, task in enumerate(node.tasks):
+                    run_id = PlannedRun(index, i)
+                    self.scheduled_runs[task["current"]] = run_id
+                    self.scheduled_ids.add(run_id)
+                    run_ids.append(run_id)
         return run_ids
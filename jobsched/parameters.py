@@ -15,46 +15,329 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import re
 import os
-from glob import glob
+from array import array
+from collections.abc import ItemsView, Mapping, ValuesView
+from operator import itemgetter
 
+from .helpers import DirectoryCache, compile_regexp, load_numpy
+from .profiling import PROFILER
 from .templates import render
 
 
-def dictunion(a, b):
-    tmp = a.copy()
-    tmp.update(b)
-    return tmp
+MISSING = -1  # value index of parameters a combination does not have
+VECTORIZE_MIN = 256  # fewer combinations are processed without NumPy
 
 
-class ParameterValues(dict):
+class _Schema:
+    """Sorted parameter names shared by all ParameterValues having them"""
+
+    __slots__ = ("keys", "positions")
+
+    _schemas = {}  # keys -> schema
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.positions = {key: i for i, key in enumerate(keys)}
+
+    @classmethod
+    def get(cls, keys):
+        schema = cls._schemas.get(keys)
+        if schema is None:
+            schema = cls._schemas[keys] = _Schema(keys)
+        return schema
+
+
+_INTERNED_VALUES = {}  # (type, value) -> value
+
+
+def _intern(value):
+    try:
+        return _INTERNED_VALUES.setdefault((type(value), value), value)
+    except TypeError:  # unhashable
+        return value
+
+
+class _ItemsView(ItemsView):
+    __slots__ = ()
+
+    def __iter__(self):
+        return zip(self._mapping._schema.keys, self._mapping._values)
+
+
+class _ValuesView(ValuesView):
+    __slots__ = ()
+
+    def __iter__(self):
+        return iter(self._mapping._values)
+
+
+class ParameterValues(Mapping):
+    """Immutable mapping of parameter names to values, usable as dict key
+
+    Stored as a schema of sorted names shared with all other instances
+    having the same names and a tuple of interned values. The hash is
+    computed once when first needed.
+    """
+
+    __slots__ = ("_schema", "_values", "_hash")
+
+    def __new__(cls, values=(), **kwargs):
+        self = object.__new__(cls)
+        if isinstance(values, ParameterValues) and not kwargs:
+            self._schema = values._schema
+            self._values = values._values
+            self._hash = values._hash
+            return self
+        items = sorted(dict(values, **kwargs).items(), key=itemgetter(0))
+        self._schema = _Schema.get(tuple(key for key, _ in items))
+        self._values = tuple(_intern(value) for _, value in items)
+        self._hash = None
+        return self
+
+    def __setitem__(self, key, value):
+        # only used when loading pickles of the former dict subclass, which
+        # are created empty and filled item by item
+        if self._hash is not None:
+            raise TypeError("ParameterValues cannot be changed once hashed")
+        values = dict(self.items())
+        values[key] = value
+        other = ParameterValues(values)
+        self._schema = other._schema
+        self._values = other._values
+
+    def __reduce__(self):
+        return (ParameterValues, (dict(self.items()),))
+
+    def __getitem__(self, key):
+        return self._values[self._schema.positions[key]]
+
+    def __contains__(self, key):
+        return key in self._schema.positions
+
+    def __iter__(self):
+        return iter(self._schema.keys)
+
+    def __len__(self):
+        return len(self._values)
+
+    def items(self):
+        return _ItemsView(self)
+
+    def values(self):
+        return _ValuesView(self)
+
+    def __eq__(self, other):
+        if isinstance(other, ParameterValues):
+            return self._schema is other._schema and self._values == other._values
+        if isinstance(other, Mapping):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
     def __hash__(self):
-        return hash(frozenset(self.items()))
+        if self._hash is None:
+            self._hash = hash((self._schema.keys, self._values))
+        return self._hash
+
+    def __repr__(self):
+        return repr(dict(self.items()))
 
     def __str__(self):
-        return ", ".join((f"{key}: {value}" for key, value in sorted(self.items())))
+        return ", ".join(f"{key}: {value}" for key, value in self.items())
 
 
 class ParameterCombinations:
+    """Possible parameter combinations
+
+    Stored column-wise: every parameter has a table of its distinct values
+    and a column holding the index into that table (or MISSING) for every
+    combination, as NumPy arrays if NumPy is available. Combinations
+    matching a set of fixed values are looked up via indexes which are built
+    lazily for each set of fixed keys that is queried.
+    """
+
     def __init__(self, combinations):
+        self.np = load_numpy()
+        self.count = 0  # number of combinations
+        self.tables = {}  # parameter -> distinct values
+        self.lookup = {}  # parameter -> value -> index in table
+        self.codes = {}  # parameter -> index of value for every combination
         if isinstance(combinations, dict):
-            self.combinations = [{}]
-            for k, v in combinations.items():
-                if isinstance(v[0], dict):
-                    self.combinations = [
-                        dictunion(a, b) for a in self.combinations for b in v
-                    ]
-                else:
-                    self.combinations = [
-                        dictunion(a, {k: b}) for a in self.combinations for b in v
-                    ]
+            self._add_product(combinations)
         else:
-            self.combinations = list(combinations).copy()
+            self._add_rows(list(combinations))
+        self._reset_indexes()
+
+    def _reset_indexes(self):
+        self._indexes = {}  # fixed keys -> fixed value indices -> combinations
+        self._recombined = {}  # (fixed keys, fixed values, free keys) -> result
+
+    @property
+    def combinations(self):
+        """All combinations as dicts"""
+        return [self._row(r) for r in range(self.count)]
+
+    def _row(self, r):
+        return {
+            key: self.tables[key][column[r]]
+            for key, column in self.codes.items()
+            if column[r] != MISSING
+        }
+
+    def _code(self, key, value):
+        """Returns index of value in the table of key, adding it if new"""
+        lookup = self.lookup.setdefault(key, {})
+        if value not in lookup:
+            lookup[value] = len(lookup)
+            self.tables.setdefault(key, []).append(value)
+        return lookup[value]
+
+    def _column(self, codes):
+        if self.np is not None:
+            return self.np.fromiter(codes, dtype=self.np.int32)
+        return array("i", codes)
+
+    def _rows(self):
+        if self.np is not None:
+            return self.np.arange(self.count)
+        return range(self.count)
+
+    def _take(self, column, rows):
+        if self.np is not None:
+            return column[rows]
+        return array("i", (column[r] for r in rows))
+
+    def _add_product(self, foreach):
+        """Sets combinations to the cartesian product of the values in foreach
+
+        Later parameters vary fastest. Values given as dicts set several
+        parameters at once.
+        """
+        dimensions = [
+            v if v and isinstance(v[0], dict) else [{k: b} for b in v]
+            for k, v in foreach.items()
+        ]
+        self.count = 1
+        for v in dimensions:
+            self.count *= len(v)
+        stride = self.count
+        for v in dimensions:
+            if not self.count:
+                break
+            stride //= len(v)
+            for key in dict.fromkeys(k for d in v for k in d):
+                table = [self._code(key, d[key]) if key in d else MISSING for d in v]
+                if self.np is not None:
+                    column = self.np.tile(
+                        self.np.repeat(self._column(table), stride),
+                        self.count // (len(v) * stride),
+                    )
+                else:
+                    column = array(
+                        "i", (table[r // stride % len(v)] for r in range(self.count))
+                    )
+                if key in self.codes:  # later values take precedence
+                    column = self._merge_column(column, self.codes[key])
+                self.codes[key] = column
+
+    def _add_rows(self, rows):
+        self.count = len(rows)
+        for key in dict.fromkeys(k for row in rows for k in row):
+            self.codes[key] = self._column(
+                self._code(key, row[key]) if key in row else MISSING for row in rows
+            )
+
+    def _merge_column(self, new, old):
+        """Takes values from new where set, from old otherwise"""
+        if self.np is not None:
+            return self.np.where(new != MISSING, new, old).astype(self.np.int32)
+        return array("i", (n if n != MISSING else o for n, o in zip(new, old)))
+
+    def _unique(self, keys, rows):
+        """Returns the distinct projections of the given combinations onto keys
+
+        as tuples of value indices, and for each combination the index of its
+        projection. Small selections are hashed directly, which is cheaper
+        than sorting them with NumPy.
+        """
+        if not keys:
+            return [()] if len(rows) else [], [0] * len(rows)
+        columns = [self._take(self.codes[k], rows) for k in keys]
+        if self.np is not None:
+            if len(rows) >= VECTORIZE_MIN:
+                return self._unique_vectorized(keys, columns)
+            columns = [c.tolist() for c in columns]
+        uniques = {}
+        inverse = [uniques.setdefault(u, len(uniques)) for u in zip(*columns)]
+        return list(uniques), inverse
 
-    def add_filecombinations(self, filepattern, workdir, *dicts):
-        new = []
-        for v in self.combinations:
+    def _unique_vectorized(self, keys, columns):
+        np = self.np
+        radices = [len(self.tables[k]) + 1 for k in keys]  # + 1 for MISSING
+        size = 1
+        for radix in radices:
+            size *= radix
+        if size >= 2 ** 62:  # does not fit into a single integer
+            uniques, inverse = np.unique(
+                np.stack(columns, axis=1), axis=0, return_inverse=True
+            )
+            return [tuple(u) for u in uniques.tolist()], inverse.reshape(-1)
+        combined = np.zeros(len(columns[0]), dtype=np.int64)
+        for radix, column in zip(radices, columns):
+            combined *= radix
+            combined += column + 1
+        combined, inverse = np.unique(combined, return_inverse=True)
+        uniques = []
+        for c in combined.tolist():
+            u = []
+            for radix in reversed(radices):
+                c, code = divmod(c, radix)
+                u.append(code - 1)
+            uniques.append(tuple(reversed(u)))
+        return uniques, inverse.reshape(-1)
+
+    def _get_index(self, fixedkeys):
+        if fixedkeys not in self._indexes:
+            uniques, inverse = self._unique(fixedkeys, self._rows())
+            if self.np is not None:
+                order = self.np.argsort(inverse, kind="stable")
+                ends = self.np.cumsum(
+                    self.np.bincount(inverse, minlength=len(uniques))
+                ).tolist()
+                starts = [0] + ends[:-1]
+                index = {
+                    u: order[start:end] for u, start, end in zip(uniques, starts, ends)
+                }
+            else:
+                index = {}
+                for r, u in enumerate(inverse):
+                    index.setdefault(uniques[u], []).append(r)
+            self._indexes[fixedkeys] = index
+        return self._indexes[fixedkeys]
+
+    @PROFILER.timed("add_filecombinations")
+    def add_filecombinations(self, filepattern, workdir, *dicts, listing=None):
+        """Adds the values of parameters missing in filepattern, for all
+        combinations of values matching existing files
+
+        The pattern is only rendered once for each distinct combination of
+        the parameters it uses.
+        """
+        if listing is None:
+            listing = DirectoryCache()
+        keys = list(self.codes)
+        if not any("{{" in str(v) for table in self.tables.values() for v in table):
+            try:
+                _, used = render(filepattern, *dicts, output_missing=True)
+                keys = [k for k in keys if k in used]
+            except Exception:  # e.g. evaluated expressions need actual values
+                pass
+        uniques, inverse = self._unique(keys, self._rows())
+
+        matches = {}  # (glob pattern, regexp) -> values of missing parameters
+        added = []  # for each projection: values to add, None to keep as is
+        for u in uniques:
+            v = {k: self.tables[k][c] for k, c in zip(keys, u) if c != MISSING}
             files, missing = render(
                 filepattern,
                 v,
@@ -76,33 +359,102 @@ class ParameterCombinations:
                     files = os.path.join(workdir, files)
                 if filepattern_regexp[0] != "/":
                     filepattern_regexp = os.path.join(workdir, filepattern_regexp)
-                r = re.compile(
-                    filepattern_regexp.replace(".", r"\.")
-                    .replace("*", r"[^\/]*")
-                    .replace("+", r"\+")
-                )
-                for f in glob(files):
-                    n = {}
-                    for m in missing:
-                        fmatch = r.match(f)
-                        if fmatch is None:
-                            raise RuntimeError(f"{f} does not match {r}")
-                        n[m] = fmatch.group(m)
-                    n.update(v)
-                    new.append(n)
+                key = (files, filepattern_regexp)
+                if key not in matches:
+                    matches[key] = self._match_files(
+                        files, filepattern_regexp, missing, listing
+                    )
+                added.append(matches[key])
             else:
-                new.append(v)
-        self.combinations = new
+                added.append(None)
+        self._expand(added, inverse)
+        self._reset_indexes()
 
-    def recombine(self, values, freekeys):
-        return frozenset(
-            ParameterValues({key: v1[key] for key in list(values.keys()) + freekeys})
-            for v1 in (
-                v2
-                for v2 in self.combinations
-                if not any(i for i in values.items() if i[1] != v2[i[0]])
-            )
+    def _expand(self, added, inverse):
+        """Replaces every combination by one for each of the dicts of values
+        added for its projection (or keeps it if None)"""
+        counts = [1 if a is None else len(a) for a in added]
+        offsets = [0]
+        for c in counts[:-1]:
+            offsets.append(offsets[-1] + c)
+        total = offsets[-1] + counts[-1] if counts else 0
+        flat = {}  # added key -> index of value for each of the added dicts
+        i = 0
+        for a in added:
+            for values in [{}] if a is None else a:
+                for key, value in values.items():
+                    flat.setdefault(key, [MISSING] * total)[i] = self._code(key, value)
+                i += 1
+
+        if self.np is not None:
+            np = self.np
+            inverse = np.asarray(inverse, dtype=np.intp)
+            row_counts = np.array(counts, dtype=np.intp)[inverse]
+            source = np.repeat(self._rows(), row_counts)
+            first = np.cumsum(row_counts) - row_counts
+            flat_index = np.array(offsets, dtype=np.intp)[
+                np.repeat(inverse, row_counts)
+            ] + (np.arange(len(source)) - np.repeat(first, row_counts))
+        else:
+            source = []
+            flat_index = []
+            for r, u in enumerate(inverse):
+                for j in range(counts[u]):
+                    source.append(r)
+                    flat_index.append(offsets[u] + j)
+
+        codes = {}
+        for key, column in self.codes.items():
+            codes[key] = self._take(column, source)
+        for key, table in flat.items():
+            column = self._take(self._column(table), flat_index)
+            if key in codes:  # existing values take precedence
+                column = self._merge_column(codes[key], column)
+            codes[key] = column
+        self.codes = codes
+        self.count = len(source)
+
+    @staticmethod
+    def _match_files(files, filepattern_regexp, missing, listing):
+        r = compile_regexp(
+            filepattern_regexp.replace(".", r"\.")
+            .replace("*", r"[^\/]*")
+            .replace("+", r"\+")
         )
+        res = []
+        for f in listing.glob(files):
+            fmatch = r.match(f)
+            if fmatch is None:
+                raise RuntimeError(f"{f} does not match {r}")
+            res.append({m: fmatch.group(m) for m in missing})
+        return res
+
+    @PROFILER.timed("recombine")
+    def recombine(self, values, freekeys):
+        fixedkeys = tuple(sorted(values.keys()))
+        fixedvalues = tuple(values[k] for k in fixedkeys)
+        cachekey = (fixedkeys, fixedvalues, tuple(sorted(freekeys)))
+        res = self._recombined.get(cachekey)
+        PROFILER.cache("recombine", res is not None)
+        if res is None:
+            res = frozenset()
+            if all(values[k] in self.lookup.get(k, {}) for k in fixedkeys):
+                rows = self._get_index(fixedkeys).get(
+                    tuple(self.lookup[k][values[k]] for k in fixedkeys), []
+                )
+                if len(rows):
+                    keys = [k for k in fixedkeys + cachekey[2] if k in self.codes]
+                    uniques, _ = self._unique(keys, rows)
+                    res = frozenset(
+                        ParameterValues(
+                            (k, self.tables[k][c])
+                            for k, c in zip(keys, u)
+                            if c != MISSING
+                        )
+                        for u in uniques
+                    )
+            self._recombined[cachekey] = res
+        return res
 
     def __repr__(self):
         return repr(self.combinations)
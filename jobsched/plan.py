@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2016-2019 Sven Willner <sven.willner@pik-potsdam.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+from .parameters import ParameterValues
+
+PLAN_VERSION = 2
+
+
+class PlannedRun:
+    """Reference to a planned submission (or a task of a planned array)"""
+
+    def __init__(self, node: int, task: int = None):
+        self.node = node
+        self.task = task
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, PlannedRun)
+            and self.node == other.node
+            and self.task == other.task
+        )
+
+    def __hash__(self):
+        return hash((self.node, self.task))
+
+    def __repr__(self):
+        if self.task is None:
+            return f"<planned {self.node}>"
+        return f"<planned {self.node}_{self.task}>"
+
+
+class PlannedSubmission:
+    """A run, array of runs or pack of runs of one job to be submitted
+
+    Each task is a dict with the parameter values ("current"), the rendered
+    parameters ("parameters"), workdir, the run ids or planned runs it
+    depends on ("dependencies"), the rendered init commands ("init"), why it
+    is to be run ("reason"), the record to store in the runfile once
+    submitted ("record"), the id of the former run it replaces ("previous")
+    and optionally the (inputs hash, input files, output files) to skip it
+    with if rerunning dependencies reproduced the same inputs
+    ("unchanged_inputs").
+    """
+
+    def __init__(self, job: str, array: bool, pack: bool = False):
+        self.job = job
+        self.array = array
+        self.pack = pack
+        self.tasks = []
+
+    def to_dict(self):
+        return {
+            "job": self.job,
+            "array": self.array,
+            "pack": self.pack,
+            "tasks": [
+                dict(
+                    task,
+                    current=dict(task["current"]),
+                    dependencies=[
+                        [d.node, d.task] if isinstance(d, PlannedRun) else str(d)
+                        for d in task["dependencies"]
+                    ],
+                )
+                for task in self.tasks
+            ],
+        }
+
+    @staticmethod
+    def from_dict(d):
+        res = PlannedSubmission(d["job"], d["array"], d["pack"])
+        for task in d["tasks"]:
+            res.tasks.append(
+                dict(
+                    task,
+                    current=ParameterValues(task["current"]),
+                    dependencies=[
+                        PlannedRun(*dep) if isinstance(dep, list) else dep
+                        for dep in task["dependencies"]
+                    ],
+                )
+            )
+        return res
+
+
+class RunGraph:
+    """Runs to be submitted, in topological order (dependencies first)
+
+    Also keeps the definition hashes of the jobs involved and the settings
+    used for planning, so that a saved plan can be checked and submitted
+    later.
+    """
+
+    def __init__(self, job: str = None, settings: dict = None):
+        self.job = job
+        self.settings = settings or {}
+        self.definitions = {}  # job name -> definition hash
+        self.nodes = []
+
+    def add(self, node: PlannedSubmission):
+        self.nodes.append(node)
+        return len(self.nodes) - 1
+
+    def merge(self, groups, array=False, pack=False):
+        """Merges each group of node indices into one node
+
+        Planned runs referring to merged nodes are updated, and the nodes are
+        sorted topologically again as a merged node waits for everything any
+        of its runs depends on. Nodes are only to be merged with nodes of the
+        same job, so that no cycles can arise.
+        """
+        moved = {}  # old node index -> (node, task offset or None if unchanged)
+        for group in groups:
+            node = PlannedSubmission(self.nodes[group[0]].job, array, pack)
+            for i in group:
+                moved[i] = (node, len(node.tasks))
+                node.tasks.extend(self.nodes[i].tasks)
+        for i, node in enumerate(self.nodes):
+            if i not in moved:
+                moved[i] = (node, None)
+
+        def target(run):
+            node, offset = moved[run.node]
+            if offset is None:
+                return node, run.task
+            return node, offset + (run.task or 0)
+
+        depends = {}
+        for node, _ in moved.values():
+            if node not in depends:
+                depends[node] = dict.fromkeys(  # ordered, for a stable order
+                    moved[d.node][0]
+                    for task in node.tasks
+                    for d in task["dependencies"]
+                    if isinstance(d, PlannedRun)
+                )
+
+        # depth-first, keeping the former order where possible
+        order = []
+        visited = set()
+        for i in range(len(self.nodes)):
+            node = moved[i][0]
+            if node in visited:
+                continue
+            visited.add(node)
+            stack = [(node, iter(depends[node]))]
+            while stack:
+                node, deps = stack[-1]
+                for dep in deps:
+                    if dep not in visited:
+                        visited.add(dep)
+                        stack.append((dep, iter(depends[dep])))
+                        break
+                else:
+                    stack.pop()
+                    order.append(node)
+
+        index = {node: i for i, node in enumerate(order)}
+        for node in order:
+            for task in node.tasks:
+                dependencies = []
+                for d in task["dependencies"]:
+                    if isinstance(d, PlannedRun):
+                        dep_node, task_index = target(d)
+                        d = PlannedRun(index[dep_node], task_index)
+                    dependencies.append(d)
+                task["dependencies"] = dependencies
+        self.nodes = order
+
+    def pack(self, job: str, size: int):
+        """Packs the single runs of job into submissions of up to size runs"""
+        singles = [
+            i
+            for i, node in enumerate(self.nodes)
+            if node.job == job and not node.array and not node.pack
+        ]
+        self.merge(
+            [singles[start : start + size] for start in range(0, len(singles), size)],
+            pack=True,
+        )
+
+    def group_arrays(self, job: str, size: int):
+        """Merges submissions of job into arrays of up to size runs
+
+        Only submissions running in the same workdir are merged, so that their
+        scripts only differ in the parameters, and only if no run has to wait
+        for more than before: either all of them wait for exactly the same
+        runs, or each waits for the task with the same index in the same
+        arrays (which Slurm supports as aftercorr), covering all their tasks.
+        Runs to be skipped at runtime if their inputs turn out unchanged are
+        left on their own.
+        """
+        corresponding = {}  # (workdir, run ids, arrays) -> [(task index, node)]
+        groups = {}  # (workdir, dependencies) -> [node]
+        for i, node in enumerate(self.nodes):
+            if (
+                node.job != job
+                or node.pack
+                or any(task.get("unchanged_inputs") for task in node.tasks)
+            ):
+                continue
+            dependencies = set(
+                frozenset(
+                    d if isinstance(d, PlannedRun) else str(d)
+                    for d in task["dependencies"]
+                )
+                for task in node.tasks
+            )
+            if len(dependencies) > 1:  # tasks of an array waiting for different runs
+                continue
+            dependencies = dependencies.pop()
+            workdir = node.tasks[-1]["workdir"]
+            groups.setdefault((workdir, dependencies), []).append(i)
+            planned = [d for d in dependencies if isinstance(d, PlannedRun)]
+            tasks = set(d.task for d in planned)
+            if len(node.tasks) == 1 and len(tasks) == 1 and None not in tasks:
+                key = (
+                    workdir,
+                    frozenset(d for d in dependencies if not isinstance(d, PlannedRun)),
+                    frozenset(d.node for d in planned),
+                )
+                corresponding.setdefault(key, []).append((tasks.pop(), i))
+
+        merged = []
+        used = set()
+        for (_, _, arrays), tasks in corresponding.items():
+            count = len(tasks)
+            if (
+                1 < count <= size
+                and all(len(self.nodes[a].tasks) == count for a in arrays)
+                and sorted(t for t, _ in tasks) == list(range(count))
+            ):
+                merged.append([i for _, i in sorted(tasks)])
+                used.update(i for _, i in tasks)
+        for indices in groups.values():
+            group = []
+            count = 0
+            for i in indices:
+                if i in used:
+                    continue
+                if count + len(self.nodes[i].tasks) > size:
+                    merged.append(group)
+                    group = []
+                    count = 0
+                group.append(i)
+                count += len(self.nodes[i].tasks)
+            merged.append(group)
+        merged = [group for group in merged if len(group) > 1]
+        if merged:
+            self.merge(merged, array=True)
+
+    def run_count(self):
+        return sum(len(node.tasks) for node in self.nodes)
+
+    def summary(self):
+        """Returns {job name: {reason: number of runs}}"""
+        res = {}
+        for node in self.nodes:
+            reasons = res.setdefault(node.job, {})
+            for task in node.tasks:
+                reasons[task["reason"]] = reasons.get(task["reason"], 0) + 1
+        return res
+
+    def save(self, filename):
+        with open(filename, "w") as f:
+            json.dump(
+                {
+                    "version": PLAN_VERSION,
+                    "job": self.job,
+                    "settings": self.settings,
+                    "definitions": self.definitions,
+                    "runs": [node.to_dict() for node in self.nodes],
+                },
+                f,
+                indent=1,
+                default=str,
+            )
+
+    @staticmethod
+    def load(filename):
+        with open(filename, "r") as f:
+            d = json.load(f)
+        if d.get("version") != PLAN_VERSION:
+            raise RuntimeError(f"Unsupported plan version in {filename}")
+        res = RunGraph(d["job"], d["settings"])
+        res.definitions = d["definitions"]
+        res.nodes = [PlannedSubmission.from_dict(node) for node in d["runs"]]
+        return res
+
+
+def expand(generator):
+    """Runs a planning generator and the ones it yields, without recursion
+
+    Generators yield further generators and are sent back their return value.
+    """
+    stack = [generator]
+    result = None
+    while stack:
+        try:
+            request = stack[-1].send(result)
+        except StopIteration as e:
+            stack.pop()
+            result = e.value
+        else:
+            stack.append(request)
+            result = None
+    return result
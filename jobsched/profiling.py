@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2016-2019 Sven Willner <sven.willner@pik-potsdam.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import functools
+import json
+import sys
+import time
+from collections import defaultdict
+
+
+class Profiler:
+    """Counts calls, time and cache hits of the phases of a run
+
+    Does nothing but check a flag unless enabled. Times are inclusive, i.e.
+    time spent in nested phases (e.g. render within init_run) is counted for
+    both. Recursive calls are only timed at the outermost level.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.calls = defaultdict(int)
+        self.times = defaultdict(float)
+        self.depth = defaultdict(int)
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self.lru_caches = {}
+        self.start = None
+
+    def enable(self):
+        self.enabled = True
+        self.start = time.perf_counter()
+
+    def timed(self, name):
+        """Decorator counting calls of and time spent in a function"""
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                self.calls[name] += 1
+                if self.depth[name]:
+                    return func(*args, **kwargs)
+                self.depth[name] += 1
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.times[name] += time.perf_counter() - start
+                    self.depth[name] -= 1
+
+            return wrapper
+
+        return decorator
+
+    def wrap_methods(self, obj, prefix, names):
+        """Times the given methods of a particular object, e.g. an executor"""
+        for n in names:
+            setattr(obj, n, self.timed(f"{prefix}.{n}")(getattr(obj, n)))
+
+    def cache(self, name, hit):
+        if self.enabled:
+            if hit:
+                self.hits[name] += 1
+            else:
+                self.misses[name] += 1
+
+    def register_lru_cache(self, name, func):
+        """Reports hits of a functools.lru_cache decorated function"""
+        self.lru_caches[name] = func
+
+    def report(self):
+        total = time.perf_counter() - self.start if self.start is not None else 0
+        caches = {}
+        for name in set(self.hits) | set(self.misses):
+            caches[name] = {"hits": self.hits[name], "misses": self.misses[name]}
+        for name, func in self.lru_caches.items():
+            info = func.cache_info()
+            caches[name] = {"hits": info.hits, "misses": info.misses}
+        for c in caches.values():
+            lookups = c["hits"] + c["misses"]
+            c["hit_rate"] = c["hits"] / lookups if lookups else None
+        return {
+            "total_time": total,
+            "phases": {
+                name: {"calls": self.calls[name], "time": self.times[name]}
+                for name in sorted(self.calls)
+            },
+            "caches": {name: caches[name] for name in sorted(caches)},
+        }
+
+    def write(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def print_summary(self, file=sys.stderr):
+        report = self.report()
+        width = max(
+            [len("phase")]
+            + [len(n) for n in report["phases"]]
+            + [len(n) for n in report["caches"]]
+        )
+        print(f"{'phase':<{width}} {'calls':>10} {'time [s]':>10}", file=file)
+        for name, p in sorted(report["phases"].items(), key=lambda i: -i[1]["time"]):
+            print(f"{name:<{width}} {p['calls']:>10} {p['time']:>10.3f}", file=file)
+        print(f"{'total':<{width}} {'':>10} {report['total_time']:>10.3f}", file=file)
+        if report["caches"]:
+            print(f"\n{'cache':<{width}} {'lookups':>10} {'hit rate':>10}", file=file)
+            for name, c in report["caches"].items():
+                rate = "-" if c["hit_rate"] is None else f"{c['hit_rate']:.1%}"
+                print(
+                    f"{name:<{width}} {c['hits'] + c['misses']:>10} {rate:>10}",
+                    file=file,
+                )
+
+
+PROFILER = Profiler()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2016-2019 Sven Willner <sven.willner@pik-potsdam.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+
+from .helpers import round_trip_load_yaml
+from .parameters import ParameterValues
+
+SQLITE_EXTENSIONS = [".db", ".sqlite", ".sqlite3"]
+
+
+def open_runfile(filename):
+    if filename.endswith(".yml"):
+        return YAMLRunfile(filename)
+    if os.path.splitext(filename)[1] in SQLITE_EXTENSIONS:
+        return SQLiteRunfile(filename)
+    return ShelveRunfile(filename)
+
+
+class Runfile:
+    """File to read/write scheduled runs from/to
+
+    former_runs maps job names to dicts mapping parameter values to run infos.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.former_runs = {}
+
+    def close(self):
+        pass
+
+    def find(self, run_id):
+        """Yields (jobname, parameters, info) of runs with ids starting with run_id"""
+        for jobname, runs in self.former_runs.items():
+            for params, info in runs.items():
+                if str(info["id"]).startswith(run_id):
+                    yield jobname, params, info
+
+    def save(self):
+        pass
+
+
+class YAMLRunfile(Runfile):
+    def __init__(self, filename):
+        Runfile.__init__(self, filename)
+        if os.path.exists(filename):
+            with open(filename, "r") as f:
+                self.former_runs = round_trip_load_yaml(f) or {}
+
+    def save(self):
+        import pyaml
+
+        with open(self.filename, "w") as f:
+            f.write(pyaml.dump(self.former_runs))
+
+
+class ShelveRunfile(Runfile):
+    def __init__(self, filename):
+        import shelve
+
+        Runfile.__init__(self, filename)
+        self.shelf = shelve.open(filename)
+        self.former_runs = self.shelf.get("former_runs", {})
+
+    def close(self):
+        self.shelf.close()
+
+    def save(self):
+        self.shelf["former_runs"] = self.former_runs
+
+
+def _parameters_key(params):
+    return json.dumps(dict(params), sort_keys=True, default=str)
+
+
+def _info_value(info):
+    return json.dumps(dict(info), sort_keys=True, default=str)
+
+
+class SQLiteRuns(dict):
+    """Runs per job name, loaded from the database when a job is first accessed
+
+    Runs are plain dicts; the serialized info as loaded is kept so that only
+    changed rows need to be written back.
+    """
+
+    def __init__(self, db):
+        dict.__init__(self)
+        self.db = db
+        self.loaded = {}  # (jobname, parameters key) -> info value as loaded
+
+    def _load(self, jobname):
+        runs = {}
+        for key, value in self.db.execute(
+            "SELECT parameters, info FROM runs WHERE job = ?", (jobname,)
+        ):
+            runs[ParameterValues(json.loads(key))] = json.loads(value)
+            self.loaded[(jobname, key)] = value
+        dict.__setitem__(self, jobname, runs)
+        return runs
+
+    def __contains__(self, jobname):
+        if dict.__contains__(self, jobname):
+            return True
+        return (
+            self.db.execute(
+                "SELECT 1 FROM runs WHERE job = ? LIMIT 1", (jobname,)
+            ).fetchone()
+            is not None
+        )
+
+    def __getitem__(self, jobname):
+        if dict.__contains__(self, jobname):
+            return dict.__getitem__(self, jobname)
+        if jobname not in self:
+            raise KeyError(jobname)
+        return self._load(jobname)
+
+    def get(self, jobname, default=None):
+        if jobname in self:
+            return self[jobname]
+        return default
+
+    def load_all(self):
+        for (jobname,) in self.db.execute("SELECT DISTINCT job FROM runs").fetchall():
+            if not dict.__contains__(self, jobname):
+                self._load(jobname)
+
+    def items(self):
+        self.load_all()
+        return dict.items(self)
+
+    def keys(self):
+        self.load_all()
+        return dict.keys(self)
+
+    def values(self):
+        self.load_all()
+        return dict.values(self)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def changed_rows(self):
+        for jobname, runs in dict.items(self):
+            for params, info in runs.items():
+                key = _parameters_key(params)
+                value = _info_value(info)
+                if self.loaded.get((jobname, key)) != value:
+                    yield jobname, key, params, info, value
+
+
+class SQLiteRunfile(Runfile):
+    """Runfile in an SQLite database, indexed by job name, run id and parameters"""
+
+    def __init__(self, filename):
+        import sqlite3
+
+        Runfile.__init__(self, filename)
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS runs (
+                job TEXT NOT NULL,
+                parameters TEXT NOT NULL,
+                run_id TEXT,
+                info TEXT NOT NULL,
+                PRIMARY KEY (job, parameters)
+            );
+            CREATE INDEX IF NOT EXISTS runs_run_id ON runs (run_id);
+            CREATE TABLE IF NOT EXISTS run_parameters (
+                job TEXT NOT NULL,
+                parameters TEXT NOT NULL,
+                name TEXT NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (job, parameters, name)
+            );
+            CREATE INDEX IF NOT EXISTS run_parameters_value
+                ON run_parameters (name, value, job);
+            """
+        )
+        self.former_runs = SQLiteRuns(self.db)
+
+    def close(self):
+        self.db.close()
+
+    def find(self, run_id):
+        for jobname, key, value in self.db.execute(
+            "SELECT job, parameters, info FROM runs WHERE run_id GLOB ?",
+            (run_id.replace("[", "[[]").replace("*", "[*]").replace("?", "[?]") + "*",),
+        ):
+            yield jobname, ParameterValues(json.loads(key)), json.loads(value)
+
+    def save(self):
+        rows = list(self.former_runs.changed_rows())
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO runs (job, parameters, run_id, info) "
+                "VALUES (?, ?, ?, ?)",
+                (
+                    (jobname, key, str(info.get("id", "")), value)
+                    for jobname, key, _, info, value in rows
+                ),
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO run_parameters (job, parameters, name, value) "
+                "VALUES (?, ?, ?, ?)",
+                (
+                    (jobname, key, name, str(v))
+                    for jobname, key, params, _, _ in rows
+                    for name, v in params.items()
+                ),
+            )
+        for jobname, key, _, _, value in rows:
+            self.former_runs.loaded[(jobname, key)] = value
+
+
+def migrate_runfile(source, target):
+    """Copies all runs from one runfile to another, e.g. into the SQLite format"""
+    for jobname, runs in source.former_runs.items():
+        target_runs = target.former_runs.get(jobname)
+        if target_runs is None:
+            target_runs = {}
+            target.former_runs[jobname] = target_runs
+        for params, info in runs.items():
+            target_runs[ParameterValues(dict(params))] = dict(info)
+    target.save()
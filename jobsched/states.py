@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2016-2019 Sven Willner <sven.willner@pik-potsdam.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import getpass
+import os
+import re
+import subprocess
+
+from .helpers import load_pyslurm
+from .profiling import PROFILER
+
+
+class JobState:
+    DONE = 0
+    WAITING = 1
+    FAILED = 2
+    RUNNING = 3
+
+
+SLURM_JOB_STATE_IDS = {
+    0: JobState.WAITING,  # JOB_PENDING
+    1: JobState.RUNNING,  # JOB_RUNNING
+    2: JobState.WAITING,  # JOB_SUSPENDED
+    3: JobState.DONE,  # JOB_COMPLETE
+    4: JobState.FAILED,  # JOB_CANCELLED
+    5: JobState.FAILED,  # JOB_FAILED
+    6: JobState.FAILED,  # JOB_TIMEOUT
+    7: JobState.FAILED,  # JOB_NODE_FAIL
+    8: JobState.WAITING,  # JOB_PREEMPTED
+    10: JobState.FAILED,  # JOB_BOOT_FAIL
+    11: JobState.FAILED, # Cancelled because of memory
+}
+
+STATE_NAMES = {
+    JobState.WAITING: "waiting",
+    JobState.RUNNING: "running",
+    JobState.DONE: "done",
+    JobState.FAILED: "failed",
+}
+
+SLURM_JOB_STATE_NAMES = {
+    "BOOT_FAIL": JobState.FAILED,
+    "CANCELLED": JobState.FAILED,
+    "COMPLETED": JobState.DONE,
+    "COMPLETING": JobState.RUNNING,
+    "CONFIGURING": JobState.RUNNING,
+    "DEADLINE": JobState.FAILED,
+    "FAILED": JobState.FAILED,
+    "NODE_FAIL": JobState.FAILED,
+    "OUT_OF_MEMORY": JobState.FAILED,
+    "PENDING": JobState.WAITING,
+    "PREEMPTED": JobState.WAITING,
+    "REQUEUED": JobState.WAITING,
+    "RESIZING": JobState.RUNNING,
+    "RUNNING": JobState.RUNNING,
+    "SUSPENDED": JobState.WAITING,
+    "TIMEOUT": JobState.FAILED,
+}
+
+# pyslurm reports NO_VAL as array task id for jobs that are not array tasks
+PYSLURM_NO_VAL = 4294967294
+
+# Maximal number of job ids passed to a single sacct/pyslurm query
+QUERY_CHUNK_SIZE = 500
+
+
+def parse_state(res: str):
+    """Maps a state as printed by squeue/sacct to a JobState"""
+    res = res.strip().split(" ")[0]  # e.g. "CANCELLED by 1234"
+    if res not in SLURM_JOB_STATE_NAMES:
+        raise RuntimeError(f"Unknown job state '{res}'")
+    return SLURM_JOB_STATE_NAMES[res]
+
+
+def expand_run_ids(run_id: str):
+    """Expands array notation like '123_[0-3,7%2]' into single task ids"""
+    m = re.match(r"([0-9]+)_\[([^\]]*)\]$", run_id)
+    if not m:
+        return [run_id]
+    res = []
+    for r in m.group(2).split("%")[0].split(","):
+        if "-" in r:
+            first, last = r.split("-")
+            res.extend(f"{m.group(1)}_{i}" for i in range(int(first), int(last) + 1))
+        elif r:
+            res.append(f"{m.group(1)}_{r}")
+    return res
+
+
+def query_output(cmd):
+    while True:
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        res = p.stdout.read().decode("utf8")
+        if not p.wait():
+            return res
+        input("Press enter...")
+
+
+def is_local(run_id: str):
+    """Whether run id (or its array master) is of a run not submitted to Slurm"""
+    return run_id.split("_")[0] in ["local", "debug"]
+
+
+def read_pack_status(logdir: str, run_id: str):
+    """Returns {member index: exit code} of the finished runs of a pack
+
+    The worker of a pack allocation appends a line "<index> <exit code>" to
+    <logdir>/<allocation id>.pack for every run it finishes.
+    """
+    res = {}
+    try:
+        with open(os.path.join(logdir, f"{run_id}.pack"), "r") as f:
+            for line in f:
+                if line.strip():
+                    index, code = line.split()
+                    res[index] = int(code)
+    except FileNotFoundError:
+        pass
+    return res
+
+
+class RunStates:
+    """Per-invocation cache of run states, filled by batched scheduler queries
+
+    Runs packed into one allocation (with ids "<allocation id>+<index>") are
+    resolved from the status file of the allocation in logdir.
+    """
+
+    def __init__(self, logdir: str = None):
+        self.cache = {}
+        self.logdir = logdir
+        self.packs = {}  # allocation id -> {member index: exit code}
+
+    @PROFILER.timed("get_run_state")
+    def prefetch(self, run_ids):
+        """Resolves the states of all given runs with as few queries as possible"""
+        pending = set()
+        for run_id in run_ids:
+            run_id = str(run_id).strip().split("+")[0]
+            if is_local(run_id):
+                self.cache[run_id] = JobState.DONE
+            elif run_id not in self.cache:
+                pending.add(run_id)
+        if not pending:
+            return
+
+        if load_pyslurm() is not None:
+            self._query_pyslurm(pending)
+        else:
+            self._query_squeue(pending)
+            self._query_sacct(set(r for r in pending if r not in self.cache))
+
+        for run_id in pending:
+            if run_id not in self.cache:  # e.g. waiting array not yet known
+                self.cache[run_id] = JobState.WAITING
+
+    def get(self, run_id: str):
+        run_id = str(run_id).strip()
+        run_id, _, member = run_id.partition("+")
+        PROFILER.cache("run state", run_id in self.cache)
+        if run_id not in self.cache:
+            self.prefetch([run_id])
+        state = self.cache[run_id]
+        if not member or self.logdir is None or is_local(run_id):
+            return state
+        if run_id not in self.packs:
+            status = read_pack_status(self.logdir, run_id)
+            if state not in [JobState.DONE, JobState.FAILED]:
+                if member not in status:
+                    return state
+                return JobState.DONE if status[member] == 0 else JobState.FAILED
+            self.packs[run_id] = status  # complete once allocation has ended
+        code = self.packs[run_id].get(member)
+        return JobState.DONE if code == 0 else JobState.FAILED
+
+    def resolve(self, info: dict):
+        """Returns state of a former run and records terminal states in its info"""
+        if info.get("success", False):
+            return JobState.DONE
+        if info.get("failed", False):
+            return JobState.FAILED
+        state = self.get(info["id"])
+        if state == JobState.DONE:
+            info["success"] = True
+        elif state == JobState.FAILED:
+            info["failed"] = True
+        return state
+
+    def resolve_all(self, infos):
+        """Resolves states of many former runs with batched queries"""
+        infos = list(infos)
+        self.prefetch(
+            info["id"]
+            for info in infos
+            if not info.get("success", False) and not info.get("failed", False)
+        )
+        return [self.resolve(info) for info in infos]
+
+    def _update(self, run_id, state, pending):
+        for r in expand_run_ids(run_id):
+            if r in pending:
+                self.cache[r] = state
+
+    def _query_pyslurm(self, pending):
+        pyslurm = load_pyslurm()
+        masters = sorted(set(r.split("_")[0] for r in pending))
+        for i in range(0, len(masters), QUERY_CHUNK_SIZE):
+            res = pyslurm.slurmdb_jobs().get(jobids=masters[i : i + QUERY_CHUNK_SIZE])
+            for jobid, info in res.items():
+                task = info.get("array_task_id")
+                if task is not None and task != PYSLURM_NO_VAL:
+                    run_id = "{}_{}".format(info["array_job_id"], task)
+                else:
+                    run_id = str(jobid)
+                self._update(run_id, SLURM_JOB_STATE_IDS[info["state"]], pending)
+
+    def _query_squeue(self, pending):
+        res = query_output(
+            ["squeue", "-h", "-r", "-u", getpass.getuser(), "-o", "%i %T"]
+        )
+        for line in res.split("\n"):
+            if line.strip():
+                run_id, state = line.split(" ", 1)
+                self._update(run_id, parse_state(state), pending)
+
+    def _query_sacct(self, pending):
+        masters = sorted(set(r.split("_")[0] for r in pending))
+        for i in range(0, len(masters), QUERY_CHUNK_SIZE):
+            res = query_output(
+                [
+                    "sacct",
+                    "-X",
+                    "-nP",
+                    "-o",
+                    "jobid,state",
+                    "-j",
+                    ",".join(masters[i : i + QUERY_CHUNK_SIZE]),
+                ]
+            )
+            for line in res.split("\n"):
+                if line.strip():
+                    run_id, state = line.split("|", 1)
+                    self._update(run_id, parse_state(state), pending)
+
+
+def query_elapsed(run_ids):
+    """Returns the elapsed seconds of completed runs by run id"""
+    run_ids = set(str(run_id).strip() for run_id in run_ids)
+    masters = sorted(
+        set(r.split("_")[0] for r in run_ids if r.split("_")[0].isdigit())
+    )
+    res = {}
+    pyslurm = load_pyslurm()
+    for i in range(0, len(masters), QUERY_CHUNK_SIZE):
+        chunk = masters[i : i + QUERY_CHUNK_SIZE]
+        if pyslurm is not None:
+            for jobid, info in pyslurm.slurmdb_jobs().get(jobids=chunk).items():
+                task = info.get("array_task_id")
+                if task is not None and task != PYSLURM_NO_VAL:
+                    run_id = "{}_{}".format(info["array_job_id"], task)
+                else:
+                    run_id = str(jobid)
+                if SLURM_JOB_STATE_IDS.get(info["state"]) == JobState.DONE:
+                    res[run_id] = int(info["elapsed"])
+        else:
+            out = query_output(
+                [
+                    "sacct",
+                    "-X",
+                    "-nP",
+                    "-o",
+                    "jobid,state,elapsedraw",
+                    "-j",
+                    ",".join(chunk),
+                ]
+            )
+            for line in out.split("\n"):
+                if line.strip():
+                    run_id, state, elapsed = line.split("|")
+                    if parse_state(state) == JobState.DONE and elapsed:
+                        for r in expand_run_ids(run_id):
+                            res[r] = int(elapsed)
+    return {r: v for r, v in res.items() if r in run_ids}
+
+
+def runtime_history(former_runs):
+    """Returns the mean runtime in seconds of the completed runs of each job"""
+    run_ids = {}
+    for jobname, runs in former_runs.items():
+        for info in runs.values():
+            if "id" in info and not info.get("failed", False):
+                run_ids[str(info["id"]).strip()] = jobname
+    elapsed = {}
+    for run_id, seconds in query_elapsed(run_ids).items():
+        elapsed.setdefault(run_ids[run_id], []).append(seconds)
+    return {jobname: sum(v) / len(v) for jobname, v in elapsed.items()}
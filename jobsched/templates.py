@@ -15,10 +15,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from functools import lru_cache
+
 import chevron
 
+from .profiling import PROFILER
+
 chevron.renderer._html_escape = lambda n: n
 
+TEMPLATE_CACHE_SIZE = 4096
+
 def eval_func(text, render):
     return str(eval(render(text)))
 
@@ -62,6 +68,16 @@ class RenderError(RuntimeError):
         RuntimeError.__init__(self, message)
 
 
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_template(text):
+    """Tokenizes template text once, result can be rendered by chevron directly"""
+    return tuple(chevron.tokenizer.tokenize(text))
+
+
+PROFILER.register_lru_cache("template", compile_template)
+
+
+@PROFILER.timed("render")
 def render(
     text,
     *dicts,
@@ -75,9 +91,9 @@ def render(
         repeated_missing_value=repeated_missing_value,
     )
     last_text = ""
-    while text != last_text:
+    while text != last_text and "{{" in text:
         last_text = text
-        text = chevron.render(text, data=render_filter)
+        text = chevron.render(compile_template(text), data=render_filter)
     if output_missing:
         return text, render_filter.missing
     if render_filter.missing:
@@ -0,0 +1,125 @@
+import glob
+import os
+import subprocess
+import sys
+
+import pytest
+
+from jobsched.executors import DryExecutor, LocalExecutor
+from jobsched.jobs import JobList
+from jobsched.parameters import ParameterCombinations
+
+
+def make_settings(tmp_path, foreach, jobs):
+    return {
+        "account": "test",
+        "logdir": str(tmp_path / "log"),
+        "workdir": str(tmp_path / "out"),
+        "const": {"_scriptsdir": str(tmp_path / "scripts")},
+        "foreach": foreach,
+        "jobs": jobs,
+    }
+
+
+def run_job(settings, job, executor):
+    joblist = JobList(settings, {}, executor)
+    possible = ParameterCombinations(settings["foreach"])
+    graph = joblist.plan(joblist.get_job(job, possible), possible)
+    executor.open()
+    joblist.submit(graph)
+    executor.close()
+    return graph
+
+
+def test_array_parameters_are_quoted(tmp_path):
+    values = ["plain", "two words", "export x", "it's", 'a "b" $c', "line\nbreak"]
+    settings = make_settings(
+        tmp_path,
+        {"v": values},
+        {
+            "echo": {
+                "array": True,
+                "parameters": {"value": "{{v}}"},
+                "code": 'printf "%s" "{{value}}" > "out_$SLURM_ARRAY_TASK_ID.txt"',
+            }
+        },
+    )
+    os.makedirs(settings["logdir"])
+    os.makedirs(settings["workdir"])
+    run_job(settings, "echo", LocalExecutor(2))
+
+    outputs = []
+    for i in range(len(values)):
+        with open(os.path.join(settings["workdir"], f"out_{i}.txt")) as f:
+            outputs.append(f.read())
+    assert sorted(outputs) == sorted(values)
+
+    # every line of the table only sets the parameters
+    (table,) = glob.glob(os.path.join(settings["logdir"], "store", "*.params"))
+    with open(table) as f:
+        for line in f:
+            p = subprocess.run(
+                ["bash", "-c", 'eval "$1"; declare -p export', "-", line],
+                capture_output=True,
+            )
+            assert p.returncode != 0, "'export' declared as variable"
+
+
+def test_python_job_imports_from_workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    settings = make_settings(
+        tmp_path, {"x": [1]}, {"py": {"filename": "job.py", "parameters": {}}}
+    )
+    os.makedirs(settings["logdir"])
+    os.makedirs(settings["workdir"])
+    os.makedirs("scripts")
+    with open("scripts/job.py", "w") as f:
+        f.write("import localmodule\n\nlocalmodule.run()\n")
+    with open(os.path.join(settings["workdir"], "localmodule.py"), "w") as f:
+        f.write("def run():\n    open('done.txt', 'w').close()\n")
+    run_job(settings, "py", LocalExecutor(1))
+
+    assert os.path.exists(os.path.join(settings["workdir"], "done.txt"))
+
+
+def test_failed_init_keeps_other_runs(tmp_path):
+    settings = make_settings(
+        tmp_path,
+        {"v": ["a", "b", "c"]},
+        {
+            "echo": {
+                "init": [{"code": '[ "{{v}}" != b ]'}],
+                "parameters": {"value": "{{v}}"},
+                "code": "true",
+            }
+        },
+    )
+    os.makedirs(settings["logdir"])
+    os.makedirs(settings["workdir"])
+    former_runs = {}
+    joblist = JobList(settings, former_runs, LocalExecutor(1))
+    possible = ParameterCombinations(settings["foreach"])
+    graph = joblist.plan(joblist.get_job("echo", possible), possible)
+    joblist.executor.open()
+    joblist.submit(graph)
+    with pytest.raises(subprocess.CalledProcessError):
+        joblist.executor.close()
+    joblist.resolve_run_ids()
+
+    runs = former_runs["echo"]
+    assert sorted(c["v"] for c in runs) == ["a", "c"]
+    assert all(isinstance(info["id"], str) for info in runs.values())
+
+
+def test_deep_dependency_chain(tmp_path):
+    depth = sys.getrecursionlimit() + 100
+    jobs = {"job0": {"inherits": "base"}, "base": {"code": "true"}}
+    for i in range(1, depth):
+        jobs[f"job{i}"] = {
+            "inherits": "base",
+            "depends": [{"job": f"job{i - 1}", "foreach": ["x"]}],
+        }
+    settings = make_settings(tmp_path, {"x": [1]}, jobs)
+    graph = run_job(settings, f"job{depth - 1}", DryExecutor())
+
+    assert [node.job for node in graph.nodes] == [f"job{i}" for i in range(depth)]